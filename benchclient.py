@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import asyncio
+import time
+
+from benchrouter import IDLE_SECONDS, connect_clients, percentiles, run
+
+# Messages sent to the actuator one by one, MESSAGE_INTERVAL apart, and then
+# all at once
+MESSAGES = 1000
+MESSAGE_INTERVAL = 0.005
+
+
+@asyncio.coroutine
+def bench_dispatch(controller, actuator, interval):
+    actuator.latencies = []
+    for _ in range(MESSAGES):
+        controller.outgoing.append({'target': actuator.name,
+                                    'action': 'bench',
+                                    'data': time.time()})
+        if interval:
+            yield from asyncio.sleep(interval)
+    yield from asyncio.sleep(2)
+    return percentiles('dispatched {}'.format(
+        '{:.0f}ms apart'.format(interval * 1e3) if interval else 'at once'),
+        actuator.latencies) + ', {} lost'.format(
+            MESSAGES - len(actuator.latencies))
+
+
+@asyncio.coroutine
+def bench_client(router):
+    actuator, = yield from connect_clients(1, prefix='actuator')
+    # Alone in this process, so the CPU of the process is that of the client
+    start = time.process_time()
+    yield from asyncio.sleep(IDLE_SECONDS)
+    idle = 'client idle: {:.2f}% of a core'.format(
+        (time.process_time() - start) / IDLE_SECONDS * 100)
+    controller, = yield from connect_clients(1, prefix='controller')
+    spread = yield from bench_dispatch(controller, actuator, MESSAGE_INTERVAL)
+    burst = yield from bench_dispatch(controller, actuator, 0)
+    return [idle, spread, burst]
+
+
+if __name__ == "__main__":
+    run(bench_client)
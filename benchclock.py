@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import asyncio
+import time
+
+from benchrouter import URI, BenchClient, named, percentiles, run
+from ilputils.clients import connect
+from ilputils.schedulers import SECOND, now_ns
+
+# Clock errors of the simulated actuators, in seconds
+SKEWS = (-0.25, 0.4, 0.0125)
+# Seconds to let the clients sync, then to sample their clocks for
+SYNC_SECONDS = 10
+SAMPLE_SECONDS = 20
+SAMPLE_INTERVAL = 0.1
+
+
+class SkewedClient(BenchClient):
+    """An actuator whose own clock is SKEW seconds off"""
+
+    SKEW = 0
+
+    def local_ns(self):
+        return now_ns() + int(self.SKEW * SECOND)
+
+
+@asyncio.coroutine
+def bench_clock(router):
+    clients = []
+    for i, skew in enumerate(SKEWS):
+        client = yield from connect(URI, klass=named(
+            SkewedClient, 'actuator{}'.format(i), SKEW=skew))
+        asyncio.get_event_loop().create_task(client.communicate())
+        clients.append(client)
+    yield from asyncio.sleep(SYNC_SECONDS)
+
+    # The router runs on this machine, its clock is ours
+    errors = [[] for _ in clients]
+    skews = []
+    for _ in range(int(SAMPLE_SECONDS / SAMPLE_INTERVAL)):
+        now = time.time()
+        times = [client.now_ns() / SECOND for client in clients]
+        for client_errors, at in zip(errors, times):
+            client_errors.append(abs(at - now))
+        skews.append(max(times) - min(times))
+        yield from asyncio.sleep(SAMPLE_INTERVAL)
+
+    results = []
+    for client, client_errors in zip(clients, errors):
+        results.append(percentiles(
+            '{} off by {:+.1f}ms, estimated offset {:+.1f}ms, rtt {:.2f}ms, '
+            'error'.format(client.name, client.SKEW * 1e3,
+                           client.clock_offset * 1e3,
+                           (client.clock_rtt or 0) * 1e3),
+            client_errors))
+    results.append(percentiles('skew between actuators', skews))
+    return results
+
+
+if __name__ == "__main__":
+    run(bench_clock)
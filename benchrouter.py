@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+import asyncio
+import contextlib
+import os
+import subprocess
+import sys
+import time
+
+from ilputils.clients import Client, connect
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+# The router under test. Point it at the blastrouter.py of another checkout
+# to compare, the clients stay the ones of this one.
+ROUTER = os.path.join(SCRIPT_DIR, 'clients', 'blastrouter', 'blastrouter.py')
+# PORT of blastrouter.py
+URI = 'ws://localhost:8810/'
+
+CLIENTS = 100
+# Seconds to measure the CPU of an idle router for
+IDLE_SECONDS = 10
+# Messages routed from one client to the others, MESSAGE_INTERVAL apart
+MESSAGES = 1000
+MESSAGE_INTERVAL = 0.005
+
+
+class BenchClient(Client):
+    """A client with a name of its own, that notes how late messages are"""
+
+    NAME = None
+
+    def __init__(self, *args, **kwargs):
+        super(BenchClient, self).__init__(*args, **kwargs)
+        self.name = self.NAME
+        self.latencies = []
+        self.register_action(self.bench)
+
+    def bench(self, sent):
+        self.latencies.append(time.time() - sent)
+
+
+def named(klass, name, **attrs):
+    """Subclass of klass that says hello with name, and has attrs"""
+    attrs.update(NAME=name, HELLO_MSG={'action': 'hello', 'name': name})
+    return type(klass.__name__, (klass, ), attrs)
+
+
+def start_router():
+    router = subprocess.Popen([sys.executable, ROUTER],
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    # Give it time to listen
+    time.sleep(1)
+    return router
+
+
+def cpu_seconds(pid):
+    """User and system CPU time of a process, from /proc"""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime, fields 14 and 15 of stat(5)
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+@asyncio.coroutine
+def connect_clients(count, klass=BenchClient, prefix='bench'):
+    """Connect count clients and let them communicate in the background"""
+    clients = []
+    for i in range(count):
+        client = yield from connect(
+            URI, klass=named(klass, '{}{}'.format(prefix, i)))
+        asyncio.get_event_loop().create_task(client.communicate())
+        clients.append(client)
+    # Let them register
+    yield from asyncio.sleep(1)
+    return clients
+
+
+def percentiles(name, values, unit=1e3, suffix='ms'):
+    values = sorted(values)
+    if not values:
+        return '{}: nothing'.format(name)
+    return '{}: {} samples, p50 {:.2f}{suffix}, p99 {:.2f}{suffix}, ' \
+        'max {:.2f}{suffix}'.format(name, len(values),
+                                    values[len(values) // 2] * unit,
+                                    values[len(values) * 99 // 100] * unit,
+                                    values[-1] * unit, suffix=suffix)
+
+
+@asyncio.coroutine
+def bench_idle(router, clients):
+    start = cpu_seconds(router.pid)
+    yield from asyncio.sleep(IDLE_SECONDS)
+    used = cpu_seconds(router.pid) - start
+    return 'router idle with {} clients: {:.1f}% of a core'.format(
+        len(clients), used / IDLE_SECONDS * 100)
+
+
+@asyncio.coroutine
+def bench_latency(clients):
+    sender, targets = clients[0], clients[1:]
+    for i in range(MESSAGES):
+        sender.outgoing.append({
+            'target': targets[i % len(targets)].name,
+            'action': 'bench',
+            'data': time.time()
+        })
+        yield from asyncio.sleep(MESSAGE_INTERVAL)
+    yield from asyncio.sleep(1)
+    latencies = [late for client in targets for late in client.latencies]
+    return percentiles('routed with {} clients'.format(len(clients)),
+                       latencies) + ', {} lost'.format(
+                           MESSAGES - len(latencies))
+
+
+@asyncio.coroutine
+def bench_router(router):
+    clients = yield from connect_clients(CLIENTS)
+    idle = yield from bench_idle(router, clients)
+    latency = yield from bench_latency(clients)
+    return [idle, latency]
+
+
+def run(bench):
+    """Run bench(router) against a router of its own, without the chatter"""
+    router = start_router()
+    try:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            results = asyncio.get_event_loop().run_until_complete(
+                bench(router))
+    finally:
+        router.terminate()
+        router.wait()
+    for result in results:
+        print(result)
+
+
+if __name__ == "__main__":
+    run(bench_router)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import json
+import random
+import time
+import tracemalloc
+from datetime import datetime
+
+from ilputils.processscheduler import ProcessScheduler
+from ilputils.schedulers import (DEFAULT, SECOND, DefaultValueSchedule,
+                                 ILPScheduler, LedsSchedule, now_ns, to_ns)
+
+ENTRIES = 100000
+# The list based default values are quadratic, keep them to fewer entries
+DEFAULT_ENTRIES = 5000
+TICK = SECOND // 50
+HOUR = 3600 * SECOND
+# Frames played while the main thread is busy with messages
+JITTER_FRAMES = 200
+JITTER_PERIOD = SECOND // 40
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = to_ns(datetime(2015, 1, 1))
+
+    def __call__(self):
+        return self.now
+
+
+class ListDefaultValueSchedule(object):
+    """The default values as they were, a list sorted on every add"""
+
+    def __init__(self, clock):
+        self._items = []
+        self._clock = clock
+
+    def add(self, start_datetime, color=DEFAULT, intensity=DEFAULT):
+        self._items.append(LedsSchedule(start_time=start_datetime, color=color,
+                                        intensity=intensity))
+        self._items = sorted(
+            (i for i in self._items if i.time >= self._clock()),
+            key=lambda x: x.time)
+
+    def expire(self, now=None):
+        pass
+
+    def get_color(self, time):
+        for item in reversed(self._items):
+            if time > item.time and item.color != DEFAULT:
+                return item.color
+
+    def get_intensity(self, time):
+        for item in reversed(self._items):
+            if time > item.time and item.intensity != DEFAULT:
+                return item.intensity
+
+
+class QuietScheduler(ILPScheduler):
+    """Plays without touching the pins"""
+
+    def _set_changes(self, settings):
+        pass
+
+
+def report(name, count, seconds):
+    print('{:<32} {:>7} in {:.3f}s, {:.1f}us each'.format(
+        name, count, seconds, seconds / count * 1e6))
+
+
+def bench_queue():
+    clock = FakeClock()
+    scheduler = ILPScheduler(clock=clock)
+    # Spread over an hour, in random order. Without color and intensity, so
+    # this times the queue of schedules and not the default values.
+    tracemalloc.start()
+    schedules = [
+        LedsSchedule(random.choice([0, 1, [0, 1]]),
+                     clock.now + random.randrange(HOUR))
+        for _ in range(ENTRIES)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('{:<32} {:>7} in {:.1f}MB, {:.0f} bytes each'.format(
+        'queue entries', ENTRIES, size / 2 ** 20, size / ENTRIES))
+
+    start = time.time()
+    for schedule in schedules:
+        scheduler.add(schedule, overwrite=True)
+    report('queue add', ENTRIES, time.time() - start)
+
+    start = time.time()
+    ticks = HOUR // TICK + 1
+    for _ in range(ticks):
+        clock.now += TICK
+        scheduler._get_changed_settings()
+    report('queue tick', ticks, time.time() - start)
+
+
+def bench_defaults(klass):
+    clock = FakeClock()
+    defaults = klass(clock=clock)
+    # An alarm: flashes every 100 ms, half of them set a color
+    times = [clock.now + i * SECOND // 10 for i in range(DEFAULT_ENTRIES)]
+
+    start = time.time()
+    for i, at in enumerate(times):
+        defaults.add(at, color=0xFF0000 if i % 2 else DEFAULT,
+                     intensity=i % 256)
+    report(klass.__name__ + ' add', DEFAULT_ENTRIES, time.time() - start)
+
+    # Play it, resolving every flash when it is due
+    start = time.time()
+    for at in times:
+        clock.now = at
+        defaults.get_color(at)
+        defaults.get_intensity(at)
+        defaults.expire(at)
+    report(klass.__name__ + ' get', DEFAULT_ENTRIES, time.time() - start)
+
+
+def inbound_load(seconds):
+    """Handle schedule_batch messages like a client would, for seconds"""
+    message = json.dumps({
+        'target': 'group:hall',
+        'action': 'schedule_batch',
+        'data': {'times': list(range(2000)), 'leds': [3] * 2000,
+                 'colors': [-1] * 2000, 'intensities': [100] * 2000}})
+    handled = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        data = json.loads(message)['data']
+        [LedsSchedule(mask, at, color, intensity)
+         for at, mask, color, intensity in zip(
+             data['times'], data['leds'], data['colors'],
+             data['intensities'])]
+        handled += 1
+    return handled
+
+
+def bench_jitter(mode):
+    if mode == 'process':
+        scheduler = ProcessScheduler(klass=QuietScheduler)
+    else:
+        scheduler = QuietScheduler()
+        played = []
+        scheduler.on_played = lambda now, settings: played.extend(
+            (setting['time'], now) for setting in settings.values())
+    scheduler.start()
+    if mode == 'process':
+        # Frames due before the process runs would be dropped, and those
+        # are the latest ones
+        scheduler.wait_ready()
+    first = now_ns() + SECOND // 2
+    deadlines = [first + i * JITTER_PERIOD for i in range(JITTER_FRAMES)]
+    scheduler.add_batch([LedsSchedule(i % 2, deadline, intensity=i % 256)
+                         for i, deadline in enumerate(deadlines)])
+    handled = inbound_load((first - now_ns()) / SECOND +
+                           JITTER_FRAMES * JITTER_PERIOD / SECOND + 0.2)
+    if mode == 'process':
+        played = [(deadline, at)
+                  for deadline, at, _, _ in scheduler.frames()]
+    scheduler.stop()
+
+    # Without the default the scheduler starts with
+    deadlines = set(deadlines)
+    lateness = sorted((at - deadline) / 1e6 for deadline, at in played
+                      if deadline in deadlines)
+    print('{:<8} {} frames, {} dropped, {} messages: late p50 {:.2f}ms, '
+          'p99 {:.2f}ms, max {:.2f}ms'.format(
+              mode, len(lateness), JITTER_FRAMES - len(lateness), handled,
+              lateness[len(lateness) // 2],
+              lateness[len(lateness) * 99 // 100], lateness[-1]))
+
+
+if __name__ == "__main__":
+    bench_queue()
+    bench_defaults(ListDefaultValueSchedule)
+    bench_defaults(DefaultValueSchedule)
+    bench_jitter('thread')
+    bench_jitter('process')
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import asyncio
+import time
+
+from benchrouter import BenchClient, connect_clients, percentiles, run
+from ilputils.schedulers import ILPScheduler
+
+# Uploads queued before every stop, of BATCH_ENTRIES entries each, sent in
+# messages of BATCH_SIZE entries like the controller's
+UPLOADS = 20
+BATCH_ENTRIES = 2000
+BATCH_SIZE = 128
+# Stop commands sent while the uploads are in flight, ROUND_DELAY apart
+ROUNDS = 10
+ROUND_DELAY = 0.5
+FRAME = ILPScheduler.TIMEGRANULARITY
+
+
+class Controller(BenchClient):
+    """Asks for acks, like the ControlClient"""
+
+    def __init__(self, *args, **kwargs):
+        super(Controller, self).__init__(*args, request_acks=True, **kwargs)
+
+
+class Actuator(BenchClient):
+    """Takes schedules and notes how late a blackout is"""
+
+    def __init__(self, *args, **kwargs):
+        super(Actuator, self).__init__(*args, **kwargs)
+        self.register_action(self.schedule_batch)
+        self.register_action(self.blackout)
+
+    def schedule_batch(self, times, leds, colors=None, intensities=None):
+        pass
+
+    def blackout(self, sent):
+        self.latencies.append(time.time() - sent)
+
+
+def upload(controller, actuator):
+    first = int(time.time() * 1e6)
+    for start in range(0, BATCH_ENTRIES, BATCH_SIZE):
+        entries = range(start, min(start + BATCH_SIZE, BATCH_ENTRIES))
+        controller.outgoing.append({
+            'target': actuator.name,
+            'action': 'schedule_batch',
+            'data': {'times': [first + i * 20000 for i in entries],
+                     'leds': [3] * len(entries),
+                     'colors': [-1] * len(entries),
+                     'intensities': [float(i % 256) for i in entries]}
+        })
+
+
+@asyncio.coroutine
+def bench_stop(controller, actuator, priority):
+    actuator.latencies = []
+    for _ in range(ROUNDS):
+        for _ in range(UPLOADS):
+            upload(controller, actuator)
+        # Let the uploads get going
+        yield from asyncio.sleep(0.01)
+        stop = {'target': actuator.name, 'action': 'blackout',
+                'data': time.time()}
+        if priority:
+            stop['priority'] = priority
+        controller.outgoing.append(stop)
+        yield from asyncio.sleep(ROUND_DELAY)
+    # Wait for the stops behind the last uploads, and the uploads
+    while len(actuator.latencies) < ROUNDS or controller.outgoing:
+        yield from asyncio.sleep(1)
+    within = sum(late <= FRAME for late in actuator.latencies)
+    return within, percentiles('stop with priority {}'.format(priority),
+                               actuator.latencies) + \
+        ', {} of {} within a frame ({:.0f}ms)'.format(within, ROUNDS,
+                                                     FRAME * 1e3)
+
+
+@asyncio.coroutine
+def bench_urgent(router):
+    controller, = yield from connect_clients(1, klass=Controller,
+                                             prefix='controller')
+    actuator, = yield from connect_clients(1, klass=Actuator,
+                                           prefix='actuator')
+    _, normal = yield from bench_stop(controller, actuator, 0)
+    within, urgent = yield from bench_stop(controller, actuator, 1)
+    assert within == ROUNDS, urgent
+    return [normal, urgent]
+
+
+if __name__ == "__main__":
+    run(bench_urgent)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import time
+from datetime import datetime, timedelta
+
+from ilputils.wire import BINARY, CODECS, JSON, to_epoch_us
+
+# Messages encoded and decoded per measurement
+REPEAT = 2000
+# Entries of a schedule_batch message
+BATCH_ENTRIES = 1000
+START = datetime(2015, 1, 1, 12)
+
+
+def schedule_message():
+    """A schedule as the controller sends it, from array_settings"""
+    return {'target': 'automata1', 'action': 'schedule',
+            'data': [str(START + timedelta(microseconds=123456)), [0, 1],
+                     0xFF0000, 192.]}
+
+
+def batch_message():
+    first = to_epoch_us(START)
+    return {'target': 'group:hall', 'action': 'schedule_batch',
+            'data': {'times': [first + i * 50000
+                               for i in range(BATCH_ENTRIES)],
+                     'leds': [1 + i % 3 for i in range(BATCH_ENTRIES)],
+                     'colors': [-1 if i % 2 else 0xFF0000
+                                for i in range(BATCH_ENTRIES)],
+                     'intensities': [float(i % 256)
+                                     for i in range(BATCH_ENTRIES)]}}
+
+
+def bench(name, message, entries):
+    for codec_name in (JSON, BINARY):
+        codec = CODECS[codec_name]
+        start = time.time()
+        for _ in range(REPEAT):
+            data = codec.encode(message)
+        encode = (time.time() - start) / REPEAT
+        start = time.time()
+        for _ in range(REPEAT):
+            codec.decode(data)
+        decode = (time.time() - start) / REPEAT
+        size = len(data.encode('utf8') if isinstance(data, str) else data)
+        print('{:<16} {:<8} {:>7} bytes, {:>6.1f} bytes/entry, encode '
+              '{:>7.1f}us, decode {:>7.1f}us, {:.2f}us/entry'.format(
+                  name, codec_name, size, size / entries, encode * 1e6,
+                  decode * 1e6, (encode + decode) / entries * 1e6))
+
+
+if __name__ == "__main__":
+    bench('schedule', schedule_message(), 1)
+    bench('schedule_batch', batch_message(), BATCH_ENTRIES)
@@ -28,15 +28,18 @@ HOST = 'automata1'
 PORT = '8020'
 
 
+def pin_key(pin=23, dutycycle=None):
+    """Commands for the same pin run in order"""
+    return pin
+
+
 class PWMClient(clients.Client):
     """Asynchronous raspberry client, waiting to pwm a pin"""
-    HELLO_MSG = clients.Client.HELLO_MSG
-    HELLO_MSG['functions'] = ['set_pin', 'print_pi']
-
     def __init__(self, *args, **kwargs):
         super(PWMClient, self).__init__(*args, **kwargs)
-        self.actions.update({set_pin.__name__: set_pin,
-                             print_pin.__name__: print_pin})
+        # set_pin forks a shell, keep it off the event loop
+        self.register_action(set_pin, blocking=True, key=pin_key)
+        self.register_action(print_pin)
 
 
 @asyncio.coroutine
@@ -51,9 +54,9 @@ def change_pin():
             host = hostnameip.get_ip(HOST)
 
     print("conneting to {}".format(host))
-    client = yield from websockets.connect('ws://{host}:{port}/'.format(
+    # Reconnects when the router goes away
+    yield from clients.run('ws://{host}:{port}/'.format(
         host=host, port=PORT), klass=PWMClient)
-    yield from client.communicate()
 
 
 if __name__ == '__main__':
@@ -21,9 +21,14 @@ UP = '..'
 SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
 sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, UP, UP)))
 
-from ilputils.clients import Client
+from ilputils.clients import Client, run
 from ilputils import hostnameip
-from ilputils.schedulers import ILPScheduler, LedsSchedule
+from ilputils.processscheduler import ProcessScheduler
+from ilputils.pwm import set_pins
+from ilputils.schedulers import (DEFAULT, ILPScheduler, LedsSchedule,
+                                 LoopScheduler, to_ns)
+from ilputils.waveforms import from_description
+from ilputils.wire import from_mask
 
 
 LOCAL = False
@@ -32,31 +37,103 @@ PORT = '8020'
 
 TIMEFORMAT = "%Y-%m-%d %H:%M:%S"
 
+# Where the schedule plays: 'thread' shares the GIL with the connection,
+# 'process' plays it in a process of its own and 'loop' on timers of the
+# event loop of the client, without waking up while there is nothing to do
+SCHEDULER = 'thread'
+SCHEDULERS = {
+    'thread': ILPScheduler,
+    'process': ProcessScheduler,
+    'loop': LoopScheduler,
+}
+# The pending schedule is kept here, so it plays on after a restart. None to
+# start with an empty schedule every time.
+SNAPSHOT = os.path.join(SCRIPT_DIR, 'schedule.snapshot')
+
 
 class TimedClient(Client):
     """A client that responds to messages with a timed function"""
     def __init__(self, *args, **kwargs):
         super(TimedClient, self).__init__(*args, **kwargs)
-        self.actions.update({
-            self.schedule.__name__: self.schedule
-        })
-        self.scheduler = ILPScheduler()
+        self.register_action(self.schedule)
+        self.register_action(self.schedule_batch)
+        self.register_action(self.schedule_wave)
+        self.register_action(self.blackout)
+        # Made on the first connection, later ones take it over in resume()
+        self.scheduler = None
+
+    def resume(self, previous):
+        super(TimedClient, self).resume(previous)
+        # The schedule plays on while we reconnect, on our clock from now on
+        self.scheduler = previous.scheduler
+        if self.scheduler is not None:
+            self.scheduler.clock = self.now_ns
+            self.scheduler.sync_clock()
+
+    def handle_time(self, data):
+        offset = self.clock_offset
+        super(TimedClient, self).handle_time(data)
+        if self.scheduler is not None and self.clock_offset != offset:
+            self.scheduler.sync_clock()
 
     def on_open(self):
-        self.scheduler.start()
-
-    def on_close(self):
-        self.scheduler.running = False
+        if self.scheduler is None:
+            # Play the schedules on the clock of the router, like the others
+            self.scheduler = SCHEDULERS[SCHEDULER](clock=self.now_ns,
+                                                   snapshot=SNAPSHOT)
+        if not self.scheduler.is_alive():
+            self.scheduler.start()
 
     def schedule(self, start_time, leds=0, color=-1, intensity=-1):
-        now = datetime.utcnow()
-        start_time = datetime.strptime(start_time.split('.')[0], TIMEFORMAT)
-        if start_time < now:
+        """Schedule at a time string, or at epoch microseconds"""
+        if isinstance(start_time, str):
+            start_time = datetime.strptime(start_time.split('.')[0],
+                                           TIMEFORMAT)
+        else:
+            start_time = start_time * 1000
+        start_time = to_ns(start_time)
+        if start_time < self.now_ns():
             return
 
         schedule = LedsSchedule(leds, start_time, color, intensity)
         self.scheduler.add(schedule)
 
+    def schedule_batch(self, times, leds, colors=None, intensities=None):
+        """
+        Schedule many at once, in columns: epoch microseconds, LED masks,
+        colors and intensities
+        """
+        if colors is None:
+            colors = [DEFAULT] * len(times)
+        if intensities is None:
+            intensities = [DEFAULT] * len(times)
+        if not len(times) == len(leds) == len(colors) == len(intensities):
+            raise ValueError('Columns of a batch must have the same length')
+
+        now = self.now_ns()
+        schedules = []
+        for epoch_us, mask, color, intensity in zip(times, leds, colors,
+                                                    intensities):
+            start_time = epoch_us * 1000
+            if start_time >= now:
+                schedules.append(LedsSchedule(from_mask(mask), start_time,
+                                              color, intensity))
+        self.scheduler.add_batch(schedules)
+
+    def schedule_wave(self, wave, start, **parameters):
+        """Play a wave from its description, see ilputils.waveforms"""
+        parameters.update(wave=wave, start=start)
+        self.scheduler.add_wave(from_description(parameters))
+
+    @asyncio.coroutine
+    def blackout(self):
+        """Drop the whole schedule and switch the leds off right away"""
+        # On the event loop, the loop scheduler is not for other threads
+        self.scheduler.clear()
+        # set_pins forks a shell, keep it off the event loop
+        yield from asyncio.get_event_loop().run_in_executor(
+            self.executor, set_pins, [[23, 0], [24, 0]])
+
 
 @asyncio.coroutine
 def change_pin():
@@ -70,9 +147,9 @@ def change_pin():
             host = hostnameip.get_ip(HOST)
 
     print("conneting to {}".format(host))
-    client = yield from websockets.connect('ws://{host}:{port}/'.format(
+    # Reconnects when the router goes away
+    yield from run('ws://{host}:{port}/'.format(
         host=host, port=PORT), klass=TimedClient)
-    yield from client.communicate()
 
 
 if __name__ == '__main__':
@@ -14,7 +14,20 @@ except ImportError:
     sys.exit(1)
 
 import json
-import collections
+import multiprocessing
+import os
+import time
+
+UP = '..'
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, UP, UP)))
+
+from ilputils.liveness import Liveness, abort
+from ilputils.messagequeue import is_urgent
+from ilputils.wire import JSON, SUBPROTOCOLS, get_codec
+from cluster import Cluster
+from queues import FairQueue, TargetQueue
+from storelog import StoreLog
 
 import logging
 logger = logging.getLogger('websockets.server')
@@ -23,8 +36,74 @@ logger.addHandler(logging.StreamHandler())
 
 
 PORT = '8810'
+ROUTER_NAME = 'router'
+# Answers to calls, they carry the id of the call and data or an error
+REPLY = 'reply'
+# Clock samples and acks, between a client and the router only. Clients
+# trust them when they come with sender ROUTER_NAME, which only we set.
+CONTROL_ACTIONS = ('time', 'ack')
 actuators = {}
 
+# Number of router processes. With more than one, all of them listen on PORT
+# (SO_REUSEPORT) and they forward messages for each other's clients over
+# unix sockets. The durable log of a client (STORE_DIR) is open in one worker
+# at a time, the one that serves it or served it last. A worker that takes
+# over a client waits up to HANDOVER_TIMEOUT seconds for the last one to
+# close the log.
+WORKERS = 1
+HANDOVER_TIMEOUT = 2
+
+# Outgoing messages per target are capped, one of 'drop-oldest',
+# 'drop-newest', 'coalesce-by-action' or 'reject' decides what to do when
+# the cap is reached. QUEUE_LIMITS overrides both per target, e.g.
+# {'automata1': (100, 'coalesce-by-action')}
+QUEUE_LIMIT = 1000
+QUEUE_POLICY = 'drop-oldest'
+QUEUE_LIMITS = {}
+
+# Directory for the durable per-target logs. When set, messages for a target
+# are stored on disk until the client acknowledges them and are replayed
+# when it reconnects. None keeps them in the in-memory queues only.
+# STORE_CHUNK stored messages are read at a time, frames queued in between
+# go out between the chunks.
+STORE_DIR = None
+STORE_CHUNK = 64
+
+# Inbound messages are served round robin per sender, SENDER_WEIGHTS[name]
+# messages per turn (DEFAULT_WEIGHT if not set). SENDER_RATES[name] limits a
+# sender to that many messages per second, DEFAULT_RATE None means no limit.
+# Messages of a sender that already has SENDER_LIMIT waiting are rejected.
+SENDER_WEIGHTS = {}
+DEFAULT_WEIGHT = 1
+SENDER_RATES = {}
+DEFAULT_RATE = None
+SENDER_LIMIT = 1000
+
+# Clients that ask for acks in their hello get a cumulative ack after
+# ACK_COUNT frames, ACK_BYTES bytes or ACK_DELAY seconds, whichever comes
+# first. Clients hold back what they send on the acks, see Client.MAX_IN_FLIGHT
+ACK_COUNT = 16
+ACK_BYTES = 1024
+ACK_DELAY = 0.2
+
+# Clients are pinged between HEARTBEAT_MIN and HEARTBEAT_MAX seconds apart,
+# more often when their round trip times jump. A client that does not answer
+# within LIVENESS_TIMEOUT seconds is disconnected.
+HEARTBEAT_MIN = 1
+HEARTBEAT_MAX = 10
+LIVENESS_TIMEOUT = 5
+
+# Named target groups, a message with "target": "group:hall" fans out to all
+# members. Clients can join groups by listing them in their hello message.
+GROUP_PREFIX = 'group:'
+GROUPS = {
+    'hall': {'automata1', 'automata2'},
+}
+
+# "target": "capability:schedule" reaches every connected client that
+# advertised the schedule action in its hello
+CAPABILITY_PREFIX = 'capability:'
+
 
 def if_exist_remove(dicti, prop):
     if dicti.get(prop):
@@ -46,59 +125,349 @@ def get_error(msg):
     return msg.get('error', 'No error found... (double error?)')
 
 
+def get_stats(msg):
+    stats = {name: queue.stats for name, queue in outgoingQueue.items()}
+    for name, store in stores.items():
+        stats.setdefault(name, {})['stored'] = store.stored
+    for name, depth in incomingQueue.stats.items():
+        stats.setdefault(name, {})['incoming'] = depth
+    for name, live in liveness.items():
+        stats.setdefault(name, {})['ping'] = live.stats
+    return stats
+
+
 ACTIONS = {
     'get_all': get_all,
     'echo': get_echo,
     'error': get_error,
+    'get_stats': get_stats,
 }
 
-incomingQueue = collections.deque()
+incomingQueue = FairQueue(SENDER_WEIGHTS, DEFAULT_WEIGHT, SENDER_RATES,
+                          DEFAULT_RATE, SENDER_LIMIT)
 outgoingQueue = {}
 connectedClients = {}
+# The connection that serves a client right now, a client that reconnects
+# before its old connection is found dead replaces it
+connections = {}
+stores = {}
+# Logs another worker still has open, name to (worker, waiter, frames that
+# came in meanwhile)
+handovers = {}
+# Round trip times per client, of the last connection
+liveness = {}
+# Links to the other workers when there is more than one
+cluster = None
+# Advertised functions per client, kept when it disconnects
+clientFunctions = {}
+# Action name to the names of the connected clients that implement it
+capabilities = {}
+
+
+class Frame(object):
+    """
+    A message on its way out, encoded once per wire format and shared by all
+    recipients
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self._encoded = {}
+
+    @property
+    def encoded(self):
+        return self.encode(get_codec(JSON))
+
+    def encode(self, codec):
+        data = self._encoded.get(codec.name, None)
+        if data is None:
+            data = codec.encode(self.message)
+            self._encoded[codec.name] = data
+        return data
+
+    def sequenced(self, seq):
+        """Copy of this frame with a sequence number, without re-encoding"""
+        frame = Frame(dict(self.message, seq=seq))
+        rest = self.encoded[1:]
+        frame._encoded[JSON] = '{{"seq": {}{}{}'.format(
+            seq, ', ' if rest != '}' else '', rest)
+        return frame
+
+
+# Put in the queue of a target to wake its sender for stored frames
+STORED = Frame({})
+
+
+def resolve_targets(target):
+    """Expand a target name, group name or list of those to client names"""
+    if isinstance(target, (list, tuple)):
+        names = []
+        for t in target:
+            names.extend(n for n in resolve_targets(t) if n not in names)
+        return names
+    if isinstance(target, str) and target.startswith(GROUP_PREFIX):
+        return sorted(GROUPS.get(target[len(GROUP_PREFIX):], ()))
+    if isinstance(target, str) and target.startswith(CAPABILITY_PREFIX):
+        return sorted(capabilities.get(target[len(CAPABILITY_PREFIX):], ()))
+    return [target]
+
+
+def implements(name, action):
+    """Clients that did not advertise their functions may get anything"""
+    funcs = clientFunctions.get(name, None)
+    return not isinstance(funcs, list) or action in funcs
+
+
+def index_capabilities(name, funcs):
+    for names in capabilities.values():
+        names.discard(name)
+    if isinstance(funcs, list):
+        for action in funcs:
+            capabilities.setdefault(action, set()).add(name)
+
+
+def get_queue(name):
+    """Return the outgoing queue of a client, create it if needed"""
+    queue = outgoingQueue.get(name, None)
+    if queue is None:
+        limit, policy = QUEUE_LIMITS.get(name, (QUEUE_LIMIT, QUEUE_POLICY))
+        queue = TargetQueue(limit, policy)
+        outgoingQueue.update({name: queue})
+    return queue
+
+
+def get_store(name):
+    """Return the durable log of a client, None if logs are disabled"""
+    if STORE_DIR is None or os.path.basename(name) != name:
+        return None
+    store = stores.get(name, None)
+    if store is None:
+        store = StoreLog(os.path.join(STORE_DIR, '{}.log'.format(name)))
+        stores.update({name: store})
+    return store
+
+
+def wake_for_store(name, store):
+    if not store.pending:
+        store.pending = True
+        # Bypass the drop policy, there is at most one marker per queue
+        get_queue(name).put_nowait(STORED)
+
+
+def deliver(sender, name, frame):
+    handover = handovers.get(name, None)
+    if handover is not None and not is_urgent(frame.message):
+        # Logged once the last owner let go of the log
+        handover[2].append((sender, frame))
+        return
+
+    store = get_store(name)
+    # Urgent frames only make sense right now, they skip the log and jump the
+    # queue instead
+    if store is not None and not is_urgent(frame.message):
+        seq = store.next_seq
+        store.append(frame.sequenced(seq).encoded.encode('utf8'))
+        wake_for_store(name, store)
+        return
+
+    try:
+        get_queue(name).offer(frame)
+    except asyncio.QueueFull:
+        message = 'Queue of {} is full, message rejected'.format(name)
+        if sender != name and frame.message.get('action') != REPLY:
+            reject(sender, frame.message.get('id', None), message)
+        else:
+            print(message)
 
 
 @asyncio.coroutine
-def broadcast(msg):
-    for k in outgoingQueue:
-        outgoingQueue[k].append(msg)
-        yield
+def take_over_store(name, worker):
+    """Wait until worker, the last owner of name, closed its durable log"""
+    waiter = asyncio.Future()
+    handovers[name] = (worker, waiter, [])
+    try:
+        yield from asyncio.wait_for(waiter, HANDOVER_TIMEOUT)
+    except asyncio.TimeoutError:
+        print('Worker {} did not release the log of {}'.format(worker, name))
+    _, _, frames = handovers.pop(name)
+    for sender, frame in frames:
+        deliver(sender, name, frame)
+
+
+def route(sender, names, frame):
+    """Deliver to our own clients, hand over to the workers of the others"""
+    remote = {}
+    for name in names:
+        if cluster is not None and cluster.is_remote(name):
+            remote.setdefault(cluster.owner(name), []).append(name)
+        else:
+            deliver(sender, name, frame)
+    for worker, worker_names in remote.items():
+        cluster.send(worker, {'type': 'route', 'sender': sender,
+                              'names': worker_names,
+                              'message': frame.message})
+
+
+def reply(sender, action, data):
+    route(sender, [sender], Frame({
+        'target': sender,
+        'action': action,
+        'data': data
+    }))
+
+
+def respond(sender, msg_id, data=None, error=None):
+    message = {
+        'target': sender,
+        'action': REPLY,
+        'id': msg_id
+    }
+    if error is None:
+        message['data'] = data
+    else:
+        message['error'] = error
+    route(sender, [sender], Frame(message))
+
+
+def reject(sender, msg_id, message):
+    """Tell the sender, as the reply to its call if it made one"""
+    print(message)
+    if msg_id is None:
+        reply(sender, 'error', message)
+    else:
+        respond(sender, msg_id, error=message)
+
+
+def broadcast(sender, frame):
+    for name in list(outgoingQueue):
+        deliver(sender, name, frame)
+
+
+def is_known(name):
+    """Connected now or before, to any worker, so messages can wait for it"""
+    return name in connectedClients or (cluster is not None and
+                                        cluster.owner(name) is not None)
+
+
+def handle_cluster_message(message):
+    kind = message.get('type')
+    name = message.get('name')
+    if kind == 'own':
+        old = connections.pop(name, None)
+        if old is not None:
+            # Reconnected to another worker
+            connectedClients[name] = False
+            old.retire()
+        clientFunctions.update({name: message['functions']})
+        index_capabilities(name, message['functions'])
+        for group in message['groups']:
+            GROUPS.setdefault(group, set()).add(name)
+        # The client is served by another worker now, hand over what we
+        # kept for it
+        queue = outgoingQueue.pop(name, None)
+        while queue is not None and not queue.empty():
+            frame = queue.get_nowait()
+            if frame is not STORED:
+                route(ROUTER_NAME, [name], frame)
+        store = stores.pop(name, None)
+        if store is not None:
+            store.close()
+        if STORE_DIR is not None:
+            # The new owner opens the log once we let go of it
+            cluster.send(message['worker'], {'type': 'released',
+                                             'name': name})
+    elif kind == 'released':
+        handover = handovers.get(name, None)
+        if (handover is not None and handover[0] == message['worker'] and
+                not handover[1].done()):
+            handover[1].set_result(None)
+    elif kind == 'drop':
+        if not cluster.is_online(name) and not connectedClients.get(name):
+            index_capabilities(name, None)
+    elif kind == 'route':
+        route(message['sender'], message['names'], Frame(message['message']))
+    elif kind == 'broadcast':
+        broadcast(message['sender'], Frame(message['message']))
 
 
 @asyncio.coroutine
 def handle_messages():
     while True:
-        while len(incomingQueue) <= 0:
-            yield
-
-        msg = incomingQueue.popleft()
-        yield
+        # Sleeps until a listener puts something in the queue, takes turns
+        # between the senders
+        sender, msg = yield from incomingQueue.get()
 
         target = msg.get('target', None)
         action = msg.get('action', 'echo')
+        priority = msg.pop('priority', 0)
+        msg_id = msg.pop('id', None)
+
+        if action in CONTROL_ACTIONS:
+            # Would pass for the router's own
+            reject(sender, msg_id, '{} is for the router only'.format(action))
+            continue
 
         if target is None:
-            yield from broadcast(msg)
+            # Whatever the client claims, it is not the router
+            msg.pop('sender', None)
+            if priority:
+                msg['priority'] = priority
+            if msg_id is not None:
+                msg['id'] = msg_id
+            broadcast(sender, Frame(msg))
+            if cluster is not None:
+                cluster.broadcast({'type': 'broadcast', 'sender': sender,
+                                   'message': msg})
             continue
 
-        client = connectedClients.get(target, None)
-        if client is None:
-            print("No client target")
+        if target == ROUTER_NAME:
+            if action not in ACTIONS:
+                reject(sender, msg_id, 'Unknown action {}'.format(action))
+            elif msg_id is not None:
+                respond(sender, msg_id, ACTIONS[action](msg))
+            else:
+                reply(sender, action, ACTIONS[action](msg))
             continue
-        output = outgoingQueue.get(target, None)
-        if output is None:
-            outgoingQueue.update({target: collections.deque()})
-            output = outgoingQueue.get(target)
+
+        names = [n for n in resolve_targets(target) if is_known(n)]
+        if not names:
+            if msg_id is not None and action != REPLY:
+                reject(sender, msg_id, 'No client {}'.format(target))
+            else:
+                print("No client target")
+            continue
+
+        unable = [n for n in names if not implements(n, action)]
+        if unable:
+            reject(sender, msg_id if action != REPLY else None,
+                   '{} not implemented by {}'.format(action,
+                                                     ', '.join(unable)))
+            names = [n for n in names if n not in unable]
+
+        # Errors of a reply travel next to its data
+        error = msg.pop('error', None) if action == REPLY else None
 
         try:
             data = msg['data']
         except KeyError:
             data = get_echo(msg)
 
-        output.append({
+        frame = Frame({
             'target': target,
             'action': action,
             'data': data
         })
+        if priority:
+            frame.message['priority'] = priority
+        if msg_id is not None:
+            frame.message['id'] = msg_id
+        if action == REPLY:
+            if error is not None:
+                frame.message['error'] = error
+        else:
+            # Only we know for sure who sent it, for replies and errors
+            frame.message['reply_to'] = sender
+        route(sender, names, frame)
 
 
 class Router(websockets.WebSocketServerProtocol):
@@ -107,12 +476,28 @@ class Router(websockets.WebSocketServerProtocol):
                  **kwargs):
         super(Router, self).__init__(ws_handler, origins=origins,
                                      subprotocols=subprotocols, **kwargs)
+        self.acks = False
+        self.received_seq = 0
+        self.unacked = 0
+        self.unacked_bytes = 0
+        self.ack_timer = None
+        self.tasks = []
+
+    @property
+    def codec(self):
+        return get_codec(self.subprotocol)
+
+    def retire(self):
+        """A newer connection serves our client, stop using this one"""
+        for task in self.tasks:
+            task.cancel()
+        abort(self)
 
     @asyncio.coroutine
     def register(self):
         print('got connection')
         hello = yield from self.recv()
-        h = json.loads(hello)
+        h = self.codec.decode(hello)
 
         a = h.get('action', None)
 
@@ -132,9 +517,37 @@ class Router(websockets.WebSocketServerProtocol):
         else:
             funcs = True
 
+        store = None
         if name:
+            old = connections.get(name, None)
+            connections[name] = self
+            if old is not None:
+                print('{} connected again, dropping its old '
+                      'connection'.format(name))
+                old.retire()
+            last_owner = None if cluster is None else cluster.owner(name)
             connectedClients.update({name: funcs})
+            clientFunctions.update({name: funcs})
+            index_capabilities(name, funcs)
+            for group in h.get('groups', ()):
+                GROUPS.setdefault(group, set()).add(name)
+            if cluster is not None:
+                cluster.own(name, funcs, h.get('groups', []))
             action = 'welcome'
+            self.acks = bool(h.get('acks', False))
+
+            if (STORE_DIR is not None and last_owner is not None and
+                    last_owner != cluster.index):
+                yield from take_over_store(name, last_owner)
+            store = get_store(name)
+            if store is not None:
+                # Replay everything after what the client got last time.
+                # Its last_seq is of another log when the epoch differs.
+                if h.get('epoch', None) == store.epoch:
+                    store.rewind(h.get('last_seq', 0))
+                else:
+                    store.rewind(0)
+                wake_for_store(name, store)
         else:
             action = 'error'
 
@@ -143,6 +556,8 @@ class Router(websockets.WebSocketServerProtocol):
             'message': message,
             'action': action
         }
+        if store is not None:
+            m['epoch'] = store.epoch
         yield from self.send_message(m)
         return name
 
@@ -150,32 +565,116 @@ class Router(websockets.WebSocketServerProtocol):
     def listener(self, path, name):
         while True:
             msg = yield from self.recv()
+            received = time.time()
             print('R>', msg)
             if msg is None:
                 break
-            yield from self.send_message(len(msg))
 
             try:
-                m = json.loads(msg)
+                m = self.codec.decode(msg)
                 if not type(m) is dict:
                     m = {'message': m}
             except ValueError:
                 m = {'action': 'error', 'error': msg}
 
-            incomingQueue.append(m)
+            seq = m.pop('seq', None)
+            if self.acks and seq is not None:
+                self.received_seq = max(self.received_seq, seq)
+                self.unacked += 1
+                self.unacked_bytes += len(msg)
+                if self.unacked >= ACK_COUNT or \
+                        self.unacked_bytes >= ACK_BYTES:
+                    yield from self.send_ack(name)
+                elif self.ack_timer is None:
+                    self.ack_timer = self.loop.call_later(
+                        ACK_DELAY, self.delayed_ack, name)
+
+            if m.get('target') == ROUTER_NAME and m.get('action') == 'time':
+                # Clock sync, answered right away as the queues would spoil
+                # the timestamps. We are the time reference.
+                yield from self.send_message({
+                    'target': name,
+                    'sender': ROUTER_NAME,
+                    'action': 'time',
+                    'data': [m.get('data'), received, time.time()]
+                })
+                continue
+
+            if m.get('target') == ROUTER_NAME and m.get('action') == 'ack':
+                store = get_store(name)
+                seq = m.get('data', 0)
+                if type(seq) is not int:
+                    print('Not an ack from {}: {!r}'.format(name, seq))
+                elif store is not None:
+                    store.ack(seq)
+                continue
+
+            try:
+                incomingQueue.put_nowait((name, m))
+            except asyncio.QueueFull:
+                # Not reading on would not help, websockets reads ahead
+                # into a queue of its own
+                reject(name, m.get('id', None),
+                       'Too many messages from {}, message rejected'.format(
+                           name))
+
+    def delayed_ack(self, name):
+        self.ack_timer = None
+        self.loop.create_task(self.send_ack(name))
+
+    @asyncio.coroutine
+    def send_ack(self, name):
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        if self.unacked:
+            self.unacked = 0
+            self.unacked_bytes = 0
+            yield from self.send_message({'target': name,
+                                          'sender': ROUTER_NAME,
+                                          'action': 'ack',
+                                          'data': self.received_seq})
 
     @asyncio.coroutine
     def sender(self, path, name):
-        while True:
-            queue = outgoingQueue.get(name, None)
+        queue = get_queue(name)
+        while self.open:
+            # Sleeps until there is something to send, serve() cancels us
+            # when the listener is done
+            frame = yield from queue.get()
+            if frame is STORED:
+                yield from self.send_stored(name)
+            else:
+                yield from self.send_frame(frame)
+
+    @asyncio.coroutine
+    def send_stored(self, name):
+        store = get_store(name)
+        store.pending = False
+        for seq, data in store.read(STORE_CHUNK):
+            print('S<', seq)
             if not self.open:
-                break
+                # Read again from here when the client reconnects
+                return
+            data = data.decode('utf8')
+            if self.codec.name != JSON:
+                data = self.codec.encode(json.loads(data))
+            yield from self.send(data)
+        if store.unread:
+            # Behind what was queued meanwhile, urgent frames first
+            wake_for_store(name, store)
 
-            try:
-                msg = queue.popleft()
-                yield from self.send_message(msg)
-            except (IndexError, AttributeError):
-                yield
+    @asyncio.coroutine
+    def heartbeat(self, path, name):
+        live = liveness[name] = Liveness(HEARTBEAT_MIN, HEARTBEAT_MAX,
+                                         LIVENESS_TIMEOUT)
+        while self.open:
+            yield from asyncio.sleep(live.interval)
+            alive = yield from live.ping(self)
+            if not alive:
+                print('No pong from {}, dropping it'.format(name))
+                abort(self)
+                return
 
     @asyncio.coroutine
     def serve(self, path):
@@ -183,27 +682,50 @@ class Router(websockets.WebSocketServerProtocol):
         if name is None:
             print("No name to serve, quiting")
             return
-        yield from asyncio.wait([
-            self.listener(path, name),
-            self.sender(path, name),
-        ])
+        self.tasks = [self.loop.create_task(handler(path, name))
+                      for handler in (self.listener, self.sender,
+                                      self.heartbeat)]
+        done, pending = yield from asyncio.wait(
+            self.tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+        if connections.get(name, None) is not self:
+            # Replaced, the client and its queue are not ours to clean up
+            return
+        del connections[name]
         connectedClients[name] = False
+        index_capabilities(name, None)
+        if cluster is not None:
+            cluster.drop(name)
 
     @asyncio.coroutine
     def send_message(self, message):
-        print('S<', message)
-        m = json.dumps(message)
+        yield from self.send_frame(Frame(message))
+
+    @asyncio.coroutine
+    def send_frame(self, frame):
+        print('S<', frame.message)
         if not self.open:
             return
-        yield from self.send(m)
+        yield from self.send(frame.encode(self.codec))
 
 
-if __name__ == '__main__':
-    print("Starting router")
-    startRouter = websockets.serve(Router.serve, 'localhost', PORT,
-                                   klass=Router)
+def run_router(worker=None):
+    global cluster
+    loop = asyncio.get_event_loop()
+    kwargs = {}
+    if worker is not None:
+        cluster = Cluster(worker, WORKERS, handle_cluster_message)
+        loop.run_until_complete(cluster.start())
+        # Every worker listens on the same port, the kernel spreads the
+        # connections
+        kwargs['reuse_port'] = True
 
-    # asyncio.get_event_loop().run_until_complete(startRouter)
+    startRouter = websockets.serve(Router.serve, 'localhost', PORT,
+                                   klass=Router, subprotocols=SUBPROTOCOLS,
+                                   **kwargs)
 
     @asyncio.coroutine
     def route_and_handle():
@@ -211,8 +733,26 @@ if __name__ == '__main__':
 
     try:
         print("Running router")
-        asyncio.get_event_loop().run_until_complete(route_and_handle())
+        loop.run_until_complete(route_and_handle())
     except KeyboardInterrupt:
         print('Exiting...')
     finally:
-        asyncio.get_event_loop().close()
+        loop.close()
+
+
+if __name__ == '__main__':
+    print("Starting router")
+    if WORKERS > 1:
+        # Spawn, so every worker sets up its own event loop and queues
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=run_router, args=(i, ))
+                   for i in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            print('Exiting...')
+    else:
+        run_router()
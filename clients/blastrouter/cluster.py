@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+
+IPC_PATH = '/tmp/blastrouter-{}.sock'
+RETRY_DELAY = 0.5
+
+
+class Cluster(object):
+    """
+    Links the router worker processes on one host over unix sockets.
+
+    Every worker announces the clients it serves, so all workers share a
+    routing table of client name to worker index, and hands the messages
+    for clients of other workers to their owner. A client that goes offline
+    stays with the worker that served it last, which queues or logs its
+    messages until it is back. Messages are JSON lines, every message is
+    passed to handler after the routing table is updated.
+    """
+
+    def __init__(self, index, workers, handler, path=IPC_PATH):
+        self.index = index
+        self.workers = workers
+        self.handler = handler
+        self.path = path
+        # Worker that serves a client, or served it last
+        self.owners = {}
+        self.online = set()
+        self._local = {}
+        self._links = {}
+
+    @property
+    def peers(self):
+        return [i for i in range(self.workers) if i != self.index]
+
+    def owner(self, name):
+        """Index of the worker that serves name, None if nobody ever did"""
+        return self.owners.get(name, None)
+
+    def is_online(self, name):
+        return name in self.online
+
+    def is_remote(self, name):
+        owner = self.owner(name)
+        return owner is not None and owner != self.index
+
+    @asyncio.coroutine
+    def start(self):
+        path = self.path.format(self.index)
+        if os.path.exists(path):
+            os.unlink(path)
+        yield from asyncio.start_unix_server(self._serve, path)
+        # Ask the others for the clients they serve already
+        self.broadcast({'type': 'hello'})
+
+    def own(self, name, functions, groups):
+        self.owners[name] = self.index
+        self.online.add(name)
+        self._local[name] = {'type': 'own', 'name': name,
+                             'functions': functions, 'groups': groups}
+        self.broadcast(self._local[name])
+
+    def drop(self, name):
+        """Our client went offline, we keep it until another worker owns it"""
+        if self.owners.get(name, None) == self.index:
+            self.online.discard(name)
+        self.broadcast({'type': 'drop', 'name': name})
+
+    def broadcast(self, message):
+        for worker in self.peers:
+            self.send(worker, message)
+
+    def send(self, worker, message):
+        link = self._links.get(worker, None)
+        if link is None:
+            link = asyncio.Queue()
+            self._links[worker] = link
+            asyncio.get_event_loop().create_task(self._link(worker, link))
+        link.put_nowait(dict(message, worker=self.index))
+
+    @asyncio.coroutine
+    def _link(self, worker, link):
+        writer = None
+        while True:
+            message = yield from link.get()
+            data = json.dumps(message).encode('utf8') + b'\n'
+            while True:
+                if writer is None:
+                    try:
+                        _, writer = yield from asyncio.open_unix_connection(
+                            self.path.format(worker))
+                    except OSError:
+                        # The peer is not up (yet)
+                        yield from asyncio.sleep(RETRY_DELAY)
+                        continue
+                writer.write(data)
+                try:
+                    yield from writer.drain()
+                    break
+                except OSError:
+                    writer = None
+
+    @asyncio.coroutine
+    def _serve(self, reader, writer):
+        while True:
+            line = yield from reader.readline()
+            if not line:
+                break
+            message = json.loads(line.decode('utf8'))
+            self._update(message)
+            self.handler(message)
+        writer.close()
+
+    def _update(self, message):
+        kind = message.get('type')
+        name = message.get('name')
+        if kind == 'hello':
+            for local, own in self._local.items():
+                self.send(message['worker'], own)
+                if local not in self.online:
+                    self.send(message['worker'], {'type': 'drop',
+                                                  'name': local})
+        elif kind == 'own':
+            self.owners[name] = message['worker']
+            self.online.add(name)
+            self._local.pop(name, None)
+        elif kind == 'drop' and self.owners.get(name) == message['worker']:
+            self.online.discard(name)
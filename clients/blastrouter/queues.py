@@ -0,0 +1,220 @@
+import asyncio
+import collections
+
+from ilputils.messagequeue import is_urgent
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce-by-action'
+REJECT = 'reject'
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE, REJECT)
+
+
+class TargetQueue(asyncio.Queue):
+    """
+    Outgoing queue of a single target, bounded by a drop policy.
+
+    When the queue holds limit frames, offer() applies the policy:
+        drop-oldest         forget the frame that waited longest
+        drop-newest         forget the offered frame
+        coalesce-by-action  replace the queued frame with the same action,
+                            or drop the oldest if there is none
+        reject              raise asyncio.QueueFull so the caller can tell
+                            the sender
+
+    Urgent frames (with a priority above 0) jump ahead of all normal frames,
+    are never dropped and do not count against the limit.
+    """
+
+    def __init__(self, limit=None, policy=DROP_OLDEST, **kwargs):
+        assert limit is None or limit > 0, 'Limit must be positive or None'
+        assert policy in POLICIES, \
+            'Policy must be one of {}, got {}'.format(POLICIES, policy)
+        super(TargetQueue, self).__init__(**kwargs)
+        self.limit = limit
+        self.policy = policy
+        self.dropped = 0
+        self.rejected = 0
+        self.urgent = 0
+
+    @property
+    def stats(self):
+        return {
+            'depth': self.qsize(),
+            'limit': self.limit,
+            'policy': self.policy,
+            'dropped': self.dropped,
+            'rejected': self.rejected,
+        }
+
+    def offer(self, frame):
+        normal = self.qsize() - self.urgent
+        if (self.limit is None or normal < self.limit or
+                is_urgent(frame.message)):
+            self.put_nowait(frame)
+            return
+
+        if self.policy == REJECT:
+            self.rejected += 1
+            raise asyncio.QueueFull
+
+        self.dropped += 1
+        if self.policy == DROP_NEWEST:
+            return
+
+        # Only normal frames are dropped, they come after the urgent ones
+        index = self.urgent
+        if self.policy == COALESCE:
+            action = frame.message.get('action')
+            for i, queued in enumerate(self._queue):
+                if i >= self.urgent and queued.message.get('action') == action:
+                    index = i
+                    break
+        del self._queue[index]
+        self.put_nowait(frame)
+
+    def _put(self, frame):
+        if is_urgent(frame.message):
+            # Behind the urgent frames, ahead of the normal ones
+            self._queue.rotate(-self.urgent)
+            self._queue.appendleft(frame)
+            self._queue.rotate(self.urgent)
+            self.urgent += 1
+        else:
+            self._queue.append(frame)
+
+    def _get(self):
+        if self.urgent:
+            self.urgent -= 1
+        return self._queue.popleft()
+
+
+class FairQueue(object):
+    """
+    Inbound queue of (sender, message) items that takes turns between
+    senders.
+
+    Every sender has its own FIFO. get() serves the senders round robin,
+    weight messages per turn, so a bulk upload from one sender does not
+    delay the small messages of the others. A sender with a rate gets a token
+    bucket of rate messages per second, one second (at least one message)
+    deep, and sits out its turns while the bucket is empty.
+
+    A sender with limit messages queued, urgent ones included, gets
+    asyncio.QueueFull from put_nowait() until some are served, so a flood
+    cannot take all memory.
+    """
+
+    def __init__(self, weights=None, default_weight=1, rates=None,
+                 default_rate=None, limit=None):
+        assert limit is None or limit > 0, 'Limit must be positive or None'
+        self.weights = {} if weights is None else weights
+        self.default_weight = default_weight
+        self.rates = {} if rates is None else rates
+        self.default_rate = default_rate
+        self.limit = limit
+        self._queues = {}
+        self._counts = collections.Counter()
+        self._turns = collections.deque()  # senders with messages
+        self._credit = {}
+        self._buckets = {}
+        self._urgent = collections.deque()
+        self._event = asyncio.Event()
+
+    @property
+    def stats(self):
+        return {sender: len(queue) for sender, queue in self._queues.items()}
+
+    def qsize(self):
+        return len(self._urgent) + sum(len(queue)
+                                       for queue in self._queues.values())
+
+    def put_nowait(self, item):
+        sender, message = item
+        if self.limit is not None and self._counts[sender] >= self.limit:
+            raise asyncio.QueueFull
+        self._counts[sender] += 1
+        if is_urgent(message):
+            self._urgent.append(item)
+            self._event.set()
+            return
+
+        queue = self._queues.get(sender, None)
+        if queue is None:
+            queue = collections.deque()
+            self._queues.update({sender: queue})
+        if not queue:
+            self._turns.append(sender)
+        queue.append(item)
+        self._event.set()
+
+    @asyncio.coroutine
+    def get(self):
+        while True:
+            item, delay = self._next()
+            if item is not None:
+                return item
+            # Sleep until a put, or until a rate limited sender may go on
+            self._event.clear()
+            try:
+                yield from asyncio.wait_for(self._event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _next(self):
+        """Return (item, None) or (None, seconds until a token is due)"""
+        if self._urgent:
+            item = self._urgent.popleft()
+            self._taken(item[0])
+            return item, None
+
+        delay = None
+        for _ in range(len(self._turns)):
+            sender = self._turns[0]
+            wait = self._take_token(sender)
+            if wait:
+                self._end_turn(sender)
+                delay = wait if delay is None else min(delay, wait)
+                continue
+
+            queue = self._queues[sender]
+            item = queue.popleft()
+            credit = self._credit.get(sender, None)
+            if credit is None:
+                credit = self.weights.get(sender, self.default_weight)
+            credit -= 1
+            if not queue:
+                self._turns.popleft()
+                self._credit.pop(sender, None)
+            elif credit <= 0:
+                self._end_turn(sender)
+            else:
+                self._credit[sender] = credit
+            self._taken(sender)
+            return item, None
+        return None, delay
+
+    def _taken(self, sender):
+        self._counts[sender] -= 1
+        if not self._counts[sender]:
+            del self._counts[sender]
+
+    def _end_turn(self, sender):
+        self._turns.rotate(-1)
+        self._credit.pop(sender, None)
+
+    def _take_token(self, sender):
+        """Take a token, or return the seconds until there is one"""
+        rate = self.rates.get(sender, self.default_rate)
+        if rate is None:
+            return 0
+        burst = max(rate, 1)
+        now = asyncio.get_event_loop().time()
+        tokens, last = self._buckets.get(sender, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        if tokens < 1:
+            self._buckets[sender] = (tokens, now)
+            return (1 - tokens) / rate
+        self._buckets[sender] = (tokens - 1, now)
+        return 0
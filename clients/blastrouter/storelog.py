@@ -0,0 +1,139 @@
+import mmap
+import os
+import struct
+import time
+
+# Epoch of the log, highest acknowledged sequence number
+HEADER = struct.Struct('<QQ')
+RECORD = struct.Struct('<QI')  # sequence number, payload length
+
+
+class StoreLog(object):
+    """
+    Append-only log of encoded frames for one target.
+
+    Frames are appended with a sequence number and read back through a
+    memory map, so the router does not need to keep them in RAM. Records up
+    to the acknowledged sequence number are cut off by compact() once they
+    take more than compact_bytes. Writes are flushed to the OS, not synced.
+
+    Sequence numbers only go up within a log. A log made anew, after its
+    file was lost, starts over at 1 with a new epoch, the microseconds since
+    the Unix epoch at its creation.
+    """
+
+    def __init__(self, path, compact_bytes=2 ** 20):
+        self.path = path
+        self.compact_bytes = compact_bytes
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(int(time.time() * 1e6), 0))
+        self._file = open(path, 'r+b')
+        self.epoch, self.acked = HEADER.unpack(self._file.read(HEADER.size))
+        self.next_seq = self.acked + 1
+        self._head = HEADER.size  # offset of the first unacknowledged record
+        self.cursor = HEADER.size  # offset of the first unread record
+        self.pending = False
+
+        end = HEADER.size
+        for seq, _, end in self._records(HEADER.size):
+            self.next_seq = max(self.next_seq, seq + 1)
+        if end < self.size:
+            # Drop a torn write at the end
+            self._file.truncate(end)
+        self._advance_head()
+
+    @property
+    def size(self):
+        return self._file.seek(0, os.SEEK_END)
+
+    @property
+    def stored(self):
+        return self.next_seq - 1 - self.acked
+
+    def append(self, data):
+        seq = self.next_seq
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(RECORD.pack(seq, len(data)))
+        self._file.write(data)
+        self._file.flush()
+        self.next_seq += 1
+        return seq
+
+    def ack(self, seq):
+        if seq <= self.acked:
+            return
+        self.acked = min(seq, self.next_seq - 1)
+        self._file.seek(0)
+        self._file.write(HEADER.pack(self.epoch, self.acked))
+        self._file.flush()
+        self._advance_head()
+        dead = self._head - HEADER.size
+        if dead > self.compact_bytes and dead * 2 > self.size:
+            self.compact()
+
+    def rewind(self, after):
+        """Acknowledge everything up to after and read on from there"""
+        self.ack(after)
+        self.cursor = self._head
+        for seq, _, offset in self._records(self._head):
+            if seq > after:
+                break
+            self.cursor = offset
+
+    @property
+    def unread(self):
+        return self.cursor < self.size
+
+    def read(self, limit):
+        """
+        Return up to limit unread (seq, data) records and move the cursor
+        on, so a backlog is never in memory as a whole
+        """
+        records = []
+        for seq, data, offset in self._records(self.cursor):
+            if len(records) >= limit:
+                break
+            records.append((seq, data))
+            self.cursor = offset
+        return records
+
+    def compact(self):
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(self.epoch, self.acked))
+            self._file.seek(self._head)
+            for chunk in iter(lambda: self._file.read(2 ** 16), b''):
+                f.write(chunk)
+        self._file.close()
+        os.replace(tmp, self.path)
+        self._file = open(self.path, 'r+b')
+        self.cursor = max(HEADER.size, self.cursor - self._head + HEADER.size)
+        self._head = HEADER.size
+
+    def close(self):
+        self._file.close()
+
+    def _advance_head(self):
+        for seq, _, offset in self._records(self._head):
+            if seq > self.acked:
+                break
+            self._head = offset
+        self.cursor = max(self.cursor, self._head)
+
+    def _records(self, offset):
+        """Yield (seq, data, end offset) for the records from offset on"""
+        self._file.flush()
+        size = self.size
+        if offset >= size:
+            return
+        with mmap.mmap(self._file.fileno(), size,
+                       access=mmap.ACCESS_READ) as m:
+            while offset + RECORD.size <= size:
+                seq, length = RECORD.unpack_from(m, offset)
+                end = offset + RECORD.size + length
+                if end > size:
+                    # Torn write at the end, ignore it
+                    break
+                yield seq, m[offset + RECORD.size:end], end
+                offset = end
@@ -107,9 +107,9 @@ def change_pin():
             host = hostnameip.get_ip(HOST)
 
     print("conneting to {}".format(host))
-    client = yield from websockets.connect('ws://{host}:{port}/'.format(
+    # Reconnects when the router goes away
+    yield from clients.run('ws://{host}:{port}/'.format(
         host=host, port=PORT), klass=ControlClient)
-    yield from client.communicate()
 
 
 if __name__ == '__main__':
@@ -5,25 +5,33 @@ import websockets
 import sys
 import os
 from datetime import datetime, timedelta
-from schedules import SimpleSchedule, AlarmSchedule
+from schedules import DEFAULT, SimpleSchedule, AlarmSchedule
 
 UTILS_PACKAGE = '..'
 SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
 sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, UTILS_PACKAGE)))
 
 from ilputils import clients, hostnameip
+from ilputils.messagequeue import URGENT
 from ilputils.timers import timeout, TimeoutError
+from ilputils.waveforms import ExponentialFade, Sine
 
 LOCAL = False
 HOST = 'automata1'
 PORT = '8020'
 TIMEFORMAT = "%Y-%m-%d %H:%M:%S"
+# Waves are evaluated as they are, they play this for the default intensity,
+# which is what the actuators start with
+DEFAULT_INTENSITY = 192
 
 
 class ControlClient(clients.Client):
     """Asynch client to control pwm outputs of raspberries"""
     def __init__(self, *args, **kwargs):
-        super(ControlClient, self).__init__(*args, **kwargs)
+        # Acks keep our uploads from crowding the sockets, so a blackout
+        # gets through ahead of them
+        super(ControlClient, self).__init__(*args, request_acks=True,
+                                            **kwargs)
         self.handlers += (self.chat, )
 
     @asyncio.coroutine
@@ -50,67 +58,106 @@ class ControlClient(clients.Client):
                 break
             yield
 
-            who = yield from self.ask_input('Who to control', 'all')
-            # DEBUG CODE @TODO REMOVE THIS
-            if who == 'all':
-                who = ['automata1', 'automata2']
-            else:
+            # A single name, a router group ("group:hall") or a comma
+            # separated list; the router does the fan-out
+            who = yield from self.ask_input('Who to control', 'group:hall')
+            if ',' in who:
                 who = [i for i in map(str.strip, who.split(','))]
 
             schedule_type = yield from self.ask_input(
-                'Which schedule (alarm, simple)', 'simple')
+                'Which schedule (alarm, fade, pulse, simple, blackout)',
+                'simple')
+            if schedule_type == 'blackout':
+                # Jumps ahead of any schedule still on its way
+                self.outgoing.append({'target': who, 'action': 'blackout',
+                                      'priority': URGENT})
+                continue
             starttime = yield from self.ask_input(
                 'At what time (format={})'.format(TIMEFORMAT),
-                datetime.utcnow() + timedelta(seconds=30))
+                self.now() + timedelta(seconds=30))
             if type(starttime) is str:
                 starttime = datetime.strptime(starttime, TIMEFORMAT)
             color = yield from self.ask_input('What color', '-1')
             intensity = yield from self.ask_input('What intensity', '-1')
 
-            color = int(color)
-            intensity = float(intensity)
-
-            m = {
-                'action': 'schedule'
-            }
-            if schedule_type == 'alarm':
-                low_intensity = yield from self.ask_input('Low intensity',
-                                                          '10')
-                flash_duration = yield from self.ask_input('Duration', '1')
-                flash_period = yield from self.ask_input('Period', '3')
-                n_flashes = yield from self.ask_input('How many times', '15')
-
-                low_intensity = float(low_intensity)
-                flash_duration = int(flash_duration)
-                flash_period = int(flash_period)
-                n_flashes = int(n_flashes)
-
-                schedule = AlarmSchedule(starttime, color, intensity,
-                                         low_intensity, flash_duration,
-                                         flash_period, n_flashes)
-            else:
-                leds = yield from self.ask_input('Which leds', '0, 1')
-                leds = [int(i) for i in map(str.strip, leds.split(','))]
-
-                schedule = SimpleSchedule()
-                schedule.add(leds, starttime, color, intensity)
+            try:
+                wave, schedule = yield from self.ask_schedule(
+                    schedule_type, starttime, int(color), float(intensity))
+            except ValueError as e:
+                print('Not a valid schedule: {}'.format(e))
+                continue
 
             yield
 
             if not self.open:
                 break
 
-            for target in who:
-                for item in schedule.items:
-                    message = dict(m)
-                    message['target'] = target
-                    message['data'] = item.array_settings
-                    self.outgoing.append(message)
-                    yield
+            if wave is not None:
+                self.outgoing.append({'target': who,
+                                      'action': 'schedule_wave',
+                                      'data': wave.description})
+            else:
+                # A few messages for the whole schedule
+                for batch in schedule.batches():
+                    self.outgoing.append({'target': who,
+                                          'action': 'schedule_batch',
+                                          'data': batch})
             print("time out !")
             yield from asyncio.sleep(2)
         print('Closing chat')
 
+    @asyncio.coroutine
+    def ask_schedule(self, schedule_type, starttime, color, intensity):
+        """
+        The rest of a schedule, as a wave or a schedule of the leds.
+        Raises ValueError for answers that do not make one.
+        """
+        # Alarms, fades and pulses go out as one wave, the actuators
+        # work out the intensities
+        wave = None
+        schedule = None
+        if schedule_type in ('alarm', 'fade', 'pulse') and \
+                intensity == DEFAULT:
+            intensity = DEFAULT_INTENSITY
+        if schedule_type == 'alarm':
+            low_intensity = yield from self.ask_input('Low intensity',
+                                                      '10')
+            flash_duration = yield from self.ask_input('Duration', '1')
+            flash_period = yield from self.ask_input('Period', '3')
+            n_flashes = yield from self.ask_input('How many times', '15')
+
+            low_intensity = float(low_intensity)
+            flash_duration = int(flash_duration)
+            flash_period = int(flash_period)
+            n_flashes = int(n_flashes)
+
+            schedule = AlarmSchedule(starttime, color, intensity,
+                                     low_intensity, flash_duration,
+                                     flash_period, n_flashes)
+            wave = schedule.wave
+        elif schedule_type == 'fade':
+            end_intensity = yield from self.ask_input('Fade to', '0')
+            duration = yield from self.ask_input('Duration', '5')
+
+            wave = ExponentialFade(starttime, float(duration), intensity,
+                                   float(end_intensity), color=color)
+        elif schedule_type == 'pulse':
+            low_intensity = yield from self.ask_input('Low intensity',
+                                                      '10')
+            period = yield from self.ask_input('Period', '2')
+            n_pulses = yield from self.ask_input('How many times', '5')
+
+            wave = Sine(starttime, float(period), intensity,
+                        float(low_intensity), int(n_pulses), color=color)
+        else:
+            leds = yield from self.ask_input('Which leds', '0, 1')
+            leds = [int(i) for i in map(str.strip, leds.split(','))]
+
+            schedule = SimpleSchedule()
+            schedule.add(leds, starttime, color, intensity)
+
+        return wave, schedule
+
 
 @asyncio.coroutine
 def change_pin():
@@ -124,9 +171,9 @@ def change_pin():
             host = hostnameip.get_ip(HOST)
 
     print("conneting to {}".format(host))
-    client = yield from websockets.connect('ws://{host}:{port}/'.format(
+    # Reconnects when the router goes away
+    yield from clients.run('ws://{host}:{port}/'.format(
         host=host, port=PORT), klass=ControlClient)
-    yield from client.communicate()
 
 
 if __name__ == '__main__':
@@ -1,8 +1,13 @@
 from datetime import timedelta
 from ilputils.schedulers import LedsSchedule
+from ilputils.waveforms import Square
+from ilputils.wire import to_mask
 
 DEFAULT = -1
 MAX_INTENSITY = 255
+# Entries per schedule_batch message. Frames are masked a byte at a time on
+# their way to the router, an urgent message waits for the one on the wire.
+BATCH_SIZE = 128
 
 
 class BaseSchedule(object):
@@ -27,6 +32,18 @@ class BaseSchedule(object):
         item = LedsSchedule(leds, start_time, color, intensity)
         self.items.append(item)
 
+    def batches(self, size=BATCH_SIZE):
+        """The items as the columns of schedule_batch messages"""
+        for start in range(0, len(self.items), size):
+            items = self.items[start:start + size]
+            yield {
+                'times': [item.time // 1000 for item in items],
+                'leds': [to_mask(item.leds) for item in items],
+                'colors': [item.color for item in items],
+                # Floats, as the binary wire format takes them
+                'intensities': [float(item.intensity) for item in items],
+            }
+
 
 class SimpleSchedule(BaseSchedule):
     """Accepts externally defined lighting scenario"""
@@ -38,6 +55,10 @@ class AlarmSchedule(BaseSchedule):
     """Have both LED arrays flash a number of times synchronously"""
     def __init__(self, start_datetime, color, high_intensity, low_intensity,
                  flash_duration, flash_period, n_flashes):
+        # The same flashes as one wave, for actuators that play them
+        self.wave = Square(start_datetime, flash_period, flash_duration,
+                           high_intensity, low_intensity, n_flashes,
+                           color=color)
         items = []
         delta = start_datetime
         for i in range(n_flashes):
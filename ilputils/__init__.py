@@ -1 +1,3 @@
-__all__ = ['clients', 'hostnameip', 'pwm', 'schedulers', 'timers']
+__all__ = ['actions', 'clients', 'hostnameip', 'liveness', 'messagequeue',
+           'processscheduler', 'pwm', 'ring', 'schedulers', 'snapshot',
+           'timers', 'waveforms', 'wire']
@@ -0,0 +1,135 @@
+import asyncio
+import inspect
+
+POSITIONAL = (inspect.Parameter.POSITIONAL_ONLY,
+              inspect.Parameter.POSITIONAL_OR_KEYWORD)
+KEYWORD = (inspect.Parameter.POSITIONAL_OR_KEYWORD,
+           inspect.Parameter.KEYWORD_ONLY)
+
+
+class BindError(Exception):
+    """The data of a message does not fit the action"""
+
+
+def split_payload(data):
+    """
+    Split message data in args and kwargs, without changing it. Understands
+        value                       one positional argument
+        [a, b]                      positional arguments
+        [a, {'b': b}]               a dict at the end holds keyword arguments
+        [a, {'b': b}, None]         ... unless it is followed by None
+        {'a': a, 'b': b}            keyword arguments
+        {'args': [a], 'b': b}       explicit args, the rest are kwargs
+        {'args': a, 'kwargs': {}}   explicit args and kwargs
+    """
+    args = ()
+    kwargs = {}
+    if isinstance(data, (tuple, list)):
+        if data and isinstance(data[-1], dict):
+            kwargs = data[-1]
+            args = data[:-1]
+        elif data and data[-1] is None:
+            args = data[:-1]
+        else:
+            args = data
+
+    elif isinstance(data, dict):
+        if 'args' in data:
+            args = data['args']
+            if not isinstance(args, (tuple, list)):
+                args = (args, )
+
+        if 'kwargs' in data:
+            kwargs = data['kwargs']
+            if not isinstance(kwargs, dict):
+                raise BindError('kwargs must be an object, got {!r}'.format(
+                    kwargs))
+        else:
+            kwargs = {k: v for k, v in data.items() if k != 'args'}
+    elif data is not None:
+        args = (data, )
+
+    return tuple(args), kwargs
+
+
+class Action(object):
+    """
+    An action a client can be asked to perform.
+
+    Blocking actions run in the worker pool of the client instead of on the
+    event loop. Calls with the same ordering key run one after the other in
+    the order they came in; key is called with the arguments of the call
+    and defaults to one key per action.
+
+    The signature of func is looked at once, here, so bind() can check the
+    data of a message before the action is called.
+    """
+
+    def __init__(self, func, name=None, blocking=False, key=None):
+        self.func = func
+        self.name = func.__name__ if name is None else name
+        self.blocking = blocking
+        self.key = key
+
+        try:
+            parameters = inspect.signature(func).parameters.values()
+        except (TypeError, ValueError):
+            # No signature to check against, anything goes
+            parameters = [
+                inspect.Parameter('args', inspect.Parameter.VAR_POSITIONAL),
+                inspect.Parameter('kwargs', inspect.Parameter.VAR_KEYWORD)]
+        self.positional = tuple(p.name for p in parameters
+                                if p.kind in POSITIONAL)
+        self.keywords = frozenset(p.name for p in parameters
+                                  if p.kind in KEYWORD)
+        self.required = tuple(p.name for p in parameters
+                              if p.default is inspect.Parameter.empty and
+                              p.kind in POSITIONAL + KEYWORD)
+        self.var_positional = any(
+            p.kind == inspect.Parameter.VAR_POSITIONAL for p in parameters)
+        self.var_keyword = any(
+            p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters)
+
+    @property
+    def is_coroutine(self):
+        return asyncio.iscoroutinefunction(self.func)
+
+    def bind(self, data):
+        """Return args and kwargs for data, BindError if they do not fit"""
+        args, kwargs = split_payload(data)
+
+        if len(args) > len(self.positional) and not self.var_positional:
+            raise BindError('{} takes {} positional arguments, got {}'.format(
+                self.name, len(self.positional), len(args)))
+
+        if not self.var_keyword:
+            unknown = set(kwargs) - self.keywords
+            if unknown:
+                raise BindError('{} got unknown arguments: {}'.format(
+                    self.name, ', '.join(sorted(unknown))))
+
+        given = self.positional[:len(args)]
+        twice = set(given) & set(kwargs)
+        if twice:
+            raise BindError('{} got more than one value for: {}'.format(
+                self.name, ', '.join(sorted(twice))))
+
+        missing = [n for n in self.required
+                   if n not in kwargs and n not in given]
+        if missing:
+            raise BindError('{} is missing arguments: {}'.format(
+                self.name, ', '.join(missing)))
+
+        return args, kwargs
+
+    def ordering_key(self, args, kwargs):
+        if self.key is None:
+            return self.name
+        try:
+            return self.key(*args, **kwargs)
+        except TypeError:
+            # The call itself will fail on these arguments as well
+            return self.name
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
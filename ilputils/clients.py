@@ -2,9 +2,28 @@
 
 import asyncio
 import websockets
-import json
 import collections
+import functools
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+from .actions import Action, BindError, split_payload
 from .hostnameip import get_hostname
+from .liveness import Liveness, abort
+from .messagequeue import MessageQueue, QueueClosed
+from .schedulers import SECOND, from_ns, now_ns
+from .wire import SUBPROTOCOLS, get_codec
+
+GROUP_PREFIX = 'group:'
+CAPABILITY_PREFIX = 'capability:'
+ROUTER_NAME = 'router'
+REPLY = 'reply'
+# Handled by every client, without being registered
+BUILTIN_ACTIONS = ('error', REPLY)
+
+
+class RemoteError(Exception):
+    """The action of a call failed, or could not be delivered"""
 
 
 class Client(websockets.WebSocketClientProtocol):
@@ -15,16 +34,104 @@ class Client(websockets.WebSocketClientProtocol):
         'name': get_hostname()
     }
 
+    # Threads for blocking actions, and how many blocking calls may wait for
+    # one before we only take urgent messages
+    WORKERS = 2
+    MAX_PENDING = 64
+    # With request_acks, bytes sent that the router did not ack yet. Past it
+    # normal messages wait in the outgoing queue, where urgent ones pass
+    # them, instead of in the sockets, where they cannot.
+    MAX_IN_FLIGHT = 2 * 1024
+    # The router is pinged between HEARTBEAT_MIN and HEARTBEAT seconds
+    # apart, the connection is dropped when a pong takes LIVENESS_TIMEOUT
+    HEARTBEAT_MIN = 1
+    HEARTBEAT = 10
+    LIVENESS_TIMEOUT = 5
+    # Clock samples taken right after connecting, and how many are kept
+    SYNC_BURST = 4
+    SYNC_SAMPLES = 8
+    CALL_TIMEOUT = 10
+    # Bounds of the reconnect delay, which doubles after every failed attempt
+    RECONNECT_MIN = 0.5
+    RECONNECT_MAX = 30
+
     def __init__(self, *args, host=None, port=None, secure=None, timeout=10,
-                 max_size=2 ** 20, loop=None):
+                 max_size=2 ** 20, loop=None, request_acks=False):
         super(Client, self).__init__(*args, host=None, port=None, secure=None,
                                      timeout=10, max_size=2 ** 20, loop=None)
         self.name = get_hostname()
-        self.incoming = collections.deque()
-        self.outgoing = collections.deque()
+        # Messages with a priority jump ahead of the others in both queues
+        self.incoming = MessageQueue()
+        self.outgoing = MessageQueue()
         self.handlers = [self.listener, self.sender, self.handle_messages,
                          self.heartbeat]
+        # Set by the listener when the connection is gone
+        self.closing = asyncio.Event()
         self.actions = {}
+        # Set executor to a ProcessPoolExecutor for CPU heavy actions. It and
+        # the order of blocking calls outlive the connection, see resume()
+        self.executor = ThreadPoolExecutor(self.WORKERS)
+        # Tasks of the blocking calls that did not finish yet
+        self.blocking = set()
+        self.ordering = {}
+        # Highest sequence number received from the router's durable log,
+        # and the epoch of that log; a new log numbers from 1 again
+        self.last_seq = 0
+        self.acked_seq = 0
+        self.log_epoch = None
+        # With request_acks the router confirms our messages by sequence
+        # number, in batches. Unconfirmed messages are kept in unacked, with
+        # their size, which adds up to in_flight.
+        self.request_acks = request_acks
+        self.sent_seq = 0
+        self.delivered_seq = 0
+        self.unacked = collections.OrderedDict()
+        self.in_flight = 0
+        # Router time minus our time, from the sample with the lowest round
+        # trip time, like NTP does
+        self.clock_offset = 0.
+        self.clock_rtt = None
+        self.clock_samples = collections.deque(maxlen=self.SYNC_SAMPLES)
+        # Round trip times to the router, see rtt_stats
+        self.liveness = Liveness(self.HEARTBEAT_MIN, self.HEARTBEAT,
+                                 self.LIVENESS_TIMEOUT)
+        # Calls waiting for their reply, by id
+        self.calls = {}
+        self.call_id = 0
+
+    @property
+    def codec(self):
+        return get_codec(self.subprotocol)
+
+    @property
+    def rtt_stats(self):
+        return self.liveness.stats
+
+    def resume(self, previous):
+        """
+        Take over the session of the client of a lost connection: the
+        messages it did not send, the calls waiting for a reply and how far
+        we got in the router's log
+        """
+        # The queue itself, what tasks of the old connection still append
+        # goes out with us
+        self.outgoing = previous.outgoing
+        self.outgoing.reopen()
+        self.outgoing.resume()
+        # The router numbers our messages per connection, so unconfirmed
+        # messages go out again, first, with new sequence numbers
+        for msg, _ in reversed(list(previous.unacked.values())):
+            self.outgoing.appendleft(msg)
+        self.last_seq = previous.last_seq
+        self.acked_seq = previous.acked_seq
+        self.log_epoch = previous.log_epoch
+        self.clock_offset = previous.clock_offset
+        self.calls = previous.calls
+        self.call_id = previous.call_id
+        # Ours has no threads yet
+        self.executor.shutdown(wait=False)
+        self.executor = previous.executor
+        self.ordering = previous.ordering
 
     @asyncio.coroutine
     def communicate(self):
@@ -40,6 +147,16 @@ class Client(websockets.WebSocketClientProtocol):
                 pass
 
             yield from asyncio.wait([i() for i in self.handlers])
+            if self.blocking:
+                # Their replies go out with the next connection. Ones that
+                # take longer keep their place in the order, see resume()
+                print('Waiting for {} blocking actions'.format(
+                    len(self.blocking)))
+                _, running = yield from asyncio.wait(self.blocking,
+                                                     timeout=self.CALL_TIMEOUT)
+                if running:
+                    print('{} blocking actions still running'.format(
+                        len(running)))
 
             try:
                 if asyncio.iscoroutine(self.on_close):
@@ -53,57 +170,270 @@ class Client(websockets.WebSocketClientProtocol):
 
     @asyncio.coroutine
     def heartbeat(self):
-        while True:
-            yield from asyncio.sleep(10)
-            if not self.open:
+        for _ in range(self.SYNC_BURST):
+            yield from self.sync_clock()
+            yield from asyncio.sleep(0.5)
+        while self.open:
+            try:
+                yield from asyncio.wait_for(self.closing.wait(),
+                                            self.liveness.interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+            alive = yield from self.liveness.ping(self)
+            if not alive:
+                # Half open, the listener would wait forever
+                print('No pong from the router, dropping the connection')
+                abort(self)
                 break
-            yield from self.pong()
+            yield from self.sync_clock()
+            if self.last_seq > self.acked_seq:
+                # Cumulative ack, so the router can drop its stored copies
+                self.acked_seq = self.last_seq
+                yield from self.send_message({'target': ROUTER_NAME,
+                                              'action': 'ack',
+                                              'data': self.acked_seq})
+
+    def now(self):
+        """UTC time on the router's clock"""
+        return from_ns(self.now_ns())
+
+    def now_ns(self):
+        """Nanoseconds since the epoch on the router's clock"""
+        return self.local_ns() + int(self.clock_offset * SECOND)
+
+    def local_ns(self):
+        """Nanoseconds since the epoch on our own clock"""
+        return now_ns()
+
+    @asyncio.coroutine
+    def sync_clock(self):
+        # Our times come from local_ns(), the clock the offset is added to,
+        # so a step of the wall clock does not end up in between
+        yield from self.send_message({'target': ROUTER_NAME, 'action': 'time',
+                                      'data': self.local_ns() / SECOND})
+
+    def handle_time(self, data):
+        """
+        Take a clock sample from the router's answer to sync_clock, with
+        t0 our send time, t1 and t2 the router's receive and send times and
+        t3 our receive time
+        """
+        t3 = self.local_ns() / SECOND
+        if not (isinstance(data, list) and len(data) == 3 and
+                all(_is_number(t) for t in data)):
+            print('Not a clock sample: {!r}'.format(data))
+            return
+        t0, t1, t2 = data
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        rtt = (t3 - t0) - (t2 - t1)
+        self.clock_samples.append((rtt, offset))
+        self.clock_rtt, self.clock_offset = min(self.clock_samples)
 
     @asyncio.coroutine
     def handle_messages(self):
         while True:
-            yield
-            if not self.open:
-                break
-
             try:
-                item = self.incoming.popleft()
-            except IndexError:
-                continue
+                # Sleeps until the listener has something for us
+                item = yield from self.incoming.get()
+            except QueueClosed:
+                break
 
-            try:
-                target, action, args, kwargs = self.clean_next_message(item)
-            except TypeError:
-                continue
+            target = item.get('target', None)
+            action = item.get('action')
 
             if target is None:
                 print('Global message:\n\taction = {}'.format(action) +
-                      '\n\targs = {}\n\tkwargs = {}'.format(args, kwargs))
+                      '\n\tdata = {}'.format(item.get('data')))
                 if action == 'talk':
                     self.outgoing.append({'broadcast': True, 'data': 'hello!'})
                 continue
-            if target == self.name and action in self.actions:
-                if asyncio.iscoroutine(self.actions[action]):
-                    yield from self.actions[action](*args, **kwargs)
-                else:
-                    self.actions[action](*args, **kwargs)
+            if self.is_target(target) and action in self.actions:
+                action = self.get_action(action)
+                try:
+                    args, kwargs = action.bind(item.get('data'))
+                except BindError as e:
+                    # Rejected before anything runs
+                    self.reject(item, e)
+                    continue
+                future = yield from self.dispatch(action, args, kwargs)
+                if item.get('id', None) is not None:
+                    future.add_done_callback(
+                        functools.partial(self.reply, item))
+            elif self.is_target(target) and action == 'error':
+                print('Error: {}'.format(item.get('data')))
 
         print('Closing messages')
 
-    def clean_next_message(self, item):
-        target = item.get('target', None)
-        action = item.get('action')
-        args, kwargs = self.extract_args_kwargs(item.get('data'))
-        return target, action, args, kwargs
+    @asyncio.coroutine
+    def call(self, target, action, *args, timeout=None, **kwargs):
+        """
+        Run action on target and return its result. Raises RemoteError when
+        it fails there and asyncio.TimeoutError without a reply in time.
+        Calls do not wait for each other, run them as tasks to have many
+        in flight.
+        """
+        self.call_id += 1
+        call_id = self.call_id
+        future = asyncio.Future()
+        self.calls[call_id] = future
+        self.outgoing.append({
+            'target': target,
+            'action': action,
+            'data': {'args': list(args), 'kwargs': kwargs},
+            'id': call_id
+        })
+        try:
+            return (yield from asyncio.wait_for(
+                future, self.CALL_TIMEOUT if timeout is None else timeout))
+        finally:
+            self.calls.pop(call_id, None)
+
+    def reply(self, item, future):
+        """Send the outcome of a call back to the caller"""
+        message = {
+            'target': item.get('reply_to'),
+            'action': REPLY,
+            'id': item['id']
+        }
+        if item.get('priority'):
+            message['priority'] = item['priority']
+        if future.cancelled():
+            message['error'] = 'Cancelled'
+        elif future.exception() is not None:
+            message['error'] = repr(future.exception())
+        else:
+            result = future.result()
+            try:
+                json.dumps(result)
+            except TypeError:
+                result = repr(result)
+            message['data'] = result
+        self.outgoing.append(message)
+
+    def reject(self, item, error):
+        """Tell the sender its message did not fit the action"""
+        print('Rejected {}: {}'.format(item.get('action'), error))
+        if item.get('id', None) is not None:
+            future = asyncio.Future()
+            future.set_exception(error)
+            self.reply(item, future)
+        elif item.get('reply_to', None) is not None:
+            self.outgoing.append({'target': item['reply_to'],
+                                  'action': 'error',
+                                  'data': str(error)})
+
+    def handle_reply(self, message):
+        future = self.calls.get(message.get('id'), None)
+        if future is None or future.done():
+            # Timed out already, or a second reply from a group
+            return
+        if 'error' in message:
+            future.set_exception(RemoteError(message['error']))
+        else:
+            future.set_result(message.get('data'))
+
+    def register_action(self, func, name=None, blocking=False, key=None):
+        """
+        Make func available as an action. Blocking actions run in the worker
+        pool, calls with the same key(*args, **kwargs) keep their order.
+        """
+        action = Action(func, name, blocking, key)
+        self.actions[action.name] = action
+        return action
+
+    def get_action(self, name):
+        action = self.actions[name]
+        if not isinstance(action, Action):
+            # Added to self.actions directly
+            action = self.actions[name] = Action(action, name)
+        return action
+
+    @asyncio.coroutine
+    def dispatch(self, action, args, kwargs):
+        """
+        Run an action, returns a future of its result. Blocking actions are
+        not waited for. Once MAX_PENDING of them are pending, the normal
+        messages wait in the incoming queue until one finishes, while urgent
+        messages go on.
+        """
+        if not action.blocking:
+            future = asyncio.Future()
+            try:
+                if action.is_coroutine:
+                    result = yield from action(*args, **kwargs)
+                else:
+                    result = action(*args, **kwargs)
+                future.set_result(result)
+            except Exception as e:
+                print('Action {} failed: {!r}'.format(action.name, e))
+                future.set_exception(e)
+            return future
+
+        key = action.ordering_key(args, kwargs)
+        lock = self.ordering.get(key, None)
+        if lock is None:
+            lock = self.ordering[key] = asyncio.Lock()
+        # Tasks start in order and the lock is fair, so calls with the same
+        # key run in the order they came in
+        task = asyncio.get_event_loop().create_task(
+            self.run_blocking(lock, action, args, kwargs))
+        self.blocking.add(task)
+        task.add_done_callback(self.blocking_done)
+        if len(self.blocking) >= self.MAX_PENDING:
+            self.incoming.pause()
+        return task
+
+    @asyncio.coroutine
+    def run_blocking(self, lock, action, args, kwargs):
+        try:
+            with (yield from lock):
+                return (yield from asyncio.get_event_loop().run_in_executor(
+                    self.executor, functools.partial(action, *args, **kwargs)))
+        except Exception as e:
+            print('Action {} failed: {!r}'.format(action.name, e))
+            raise
+
+    def blocking_done(self, task):
+        self.blocking.discard(task)
+        if len(self.blocking) < self.MAX_PENDING:
+            self.incoming.resume()
+
+    def is_target(self, target):
+        """
+        The router resolves lists, groups and capabilities, so those are
+        meant for us
+        """
+        if isinstance(target, (list, tuple)):
+            return True
+        if isinstance(target, str) and target.startswith(
+                (GROUP_PREFIX, CAPABILITY_PREFIX)):
+            return True
+        return target == self.name
 
     @asyncio.coroutine
     def register(self):
-        yield from self.send_message(self.__class__.HELLO_MSG)
+        hello = dict(self.__class__.HELLO_MSG, last_seq=self.last_seq,
+                     epoch=self.log_epoch, acks=self.request_acks)
+        # Advertise our actions, the router indexes them for
+        # capability-based routing and rejects anything else
+        hello.setdefault('functions',
+                         sorted(set(self.actions) | set(BUILTIN_ACTIONS)))
+        yield from self.send_message(hello)
         welcome = yield from self.recv()
-        w = json.loads(welcome)
+        if welcome is None:
+            print('Connection lost')
+            self.name = None
+            return
+        w = self.codec.decode(welcome)
         if w['action'] != 'welcome':
             print('Not welcome...')
             self.name = None
+        elif w.get('epoch', None) != self.log_epoch:
+            # The router replays its new log from the start
+            self.log_epoch = w.get('epoch', None)
+            self.last_seq = 0
+            self.acked_seq = 0
 
     @asyncio.coroutine
     def send_message(self, message, broadcast=False):
@@ -111,100 +441,169 @@ class Client(websockets.WebSocketClientProtocol):
             message = {'message': message}
         if not broadcast and message.get('target', None) is None:
             message['target'] = self.name
-        m = json.dumps(message)
+        m = self.codec.encode(message)
         if not self.open:
-            return
+            return 0
         yield from self.send(m)
-        print("> {}".format(m))
+        print("> {}".format(message))
+        return len(m)
 
     @asyncio.coroutine
     def listener(self):
+        try:
+            yield from self.listen()
+        finally:
+            # Wake up the other stages so they can finish
+            self.closing.set()
+            self.incoming.close()
+            self.outgoing.close()
+        print('Closing listener')
+
+    @asyncio.coroutine
+    def listen(self):
         while True:
             message = yield from self.recv()
             if message is None:
                 break
 
             try:
-                m = json.loads(message)
+                m = self.codec.decode(message)
                 if not type(m) is dict:
                     m = {'message': m}
             except ValueError:
                 m = {'action': 'error', 'error': message}
 
             print("< {}".format(message))
+            # Only the router sets the sender, other clients could send
+            # time and ack actions too
+            if m.get('sender') == ROUTER_NAME and m.get('action') == 'ack':
+                self.confirm(m.get('data', 0))
+                continue
+            if m.get('sender') == ROUTER_NAME and m.get('action') == 'time':
+                self.handle_time(m.get('data'))
+                continue
+
+            seq = m.get('seq', None)
+            if seq is not None:
+                if seq <= self.last_seq:
+                    # Replayed by the router, we already have it
+                    continue
+                self.last_seq = seq
+            if m.get('action') == REPLY:
+                self.handle_reply(m)
+                continue
             self.incoming.append(m)
-        print('Closing listener')
 
     @asyncio.coroutine
     def sender(self):
         while True:
+            try:
+                # Sleeps until there is something to send
+                msg = yield from self.outgoing.get()
+            except QueueClosed:
+                break
             if not self.open:
+                # Keep it for whoever uses the queue next
+                self.outgoing.appendleft(msg)
                 break
-            yield
-            try:
-                msg = self.outgoing.popleft()
-            except IndexError:
-                continue
 
             broadcast = msg.get('broadcast', False)
             if broadcast:
                 del msg['broadcast']
 
-            yield from self.send_message(msg, broadcast)
+            if not self.request_acks:
+                yield from self.send_message(msg, broadcast)
+                continue
+
+            self.sent_seq += 1
+            msg['seq'] = seq = self.sent_seq
+            self.unacked[seq] = (msg, 0)
+            size = yield from self.send_message(msg, broadcast)
+            if seq in self.unacked:
+                self.unacked[seq] = (msg, size)
+                self.in_flight += size
+                if self.in_flight >= self.MAX_IN_FLIGHT:
+                    self.outgoing.pause()
         print('Closing sender')
 
+    def confirm(self, seq):
+        """Handle a cumulative ack from the router"""
+        if type(seq) is not int:
+            print('Not an ack: {!r}'.format(seq))
+            return
+        self.delivered_seq = max(self.delivered_seq, seq)
+        while self.unacked:
+            first = next(iter(self.unacked))
+            if first > seq:
+                break
+            self.in_flight -= self.unacked.pop(first)[1]
+        if self.in_flight < self.MAX_IN_FLIGHT:
+            self.outgoing.resume()
+
     def extract_args_kwargs(self, data):
-        args = ()
-        kwargs = {}
-        if isinstance(data, (tuple, list)):
-            # We got an array of data
-            if isinstance(data[-1], dict):
-                # There is a dictionary at the end of the array
-                # So we assume those are the kwargs
-                # If you have a dict as last arg, use a extra None
-                kwargs = data[-1]
-                args = data[:-1]
-            elif data[-1] is None:
-                # Here we handle the possibility of a dict as last
-                # arg
-                args = data[:-1]
-            else:
-                args = data
-
-        elif isinstance(data, dict):
-            # We got a dict as data, so we have to investigate
-            # which message type is used
-            if 'args' in data:
-                # We got some explicit args
-                args = data.get('args')
-                if not isinstance(args, (tuple, list)):
-                    # If it is not an array, make it so
-                    # Because of unpacking later on
-                    args = (args, )
-                # Unset it, so it won't appear in the kwargs
-                del data['args']
-
-            if 'kwargs' in data:
-                # We got explicit kwargs, so we expect all kwargs
-                # to be in this dict
-                kwargs = data.get('kwargs')
-                assert isinstance(kwargs, dict)
+        return split_payload(data)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+@asyncio.coroutine
+def connect(uri, klass=Client, **kwargs):
+    """Connect a client, offering the wire formats we know"""
+    kwargs.setdefault('subprotocols', SUBPROTOCOLS)
+    client = yield from websockets.connect(uri, klass=klass, **kwargs)
+    return client
+
+
+@asyncio.coroutine
+def run(uri, klass=Client, **kwargs):
+    """
+    Connect a client and communicate, forever. A lost connection is made
+    again and resumes the session of the last one. Attempts wait a random
+    part of a delay that doubles up to klass.RECONNECT_MAX, so a fleet does
+    not reconnect all at once when the router comes back.
+    """
+    client = previous = None
+    delay = klass.RECONNECT_MIN
+    try:
+        while True:
+            try:
+                client = yield from connect(uri, klass=klass, **kwargs)
+            except (OSError, websockets.InvalidHandshake) as e:
+                print('Could not connect: {!r}'.format(e))
             else:
-                kwargs = data
-        elif data is not None:
-            # We got a single value
-            args = (data, )
+                if previous is not None:
+                    client.resume(previous)
+                try:
+                    yield from client.communicate()
+                except Exception as e:
+                    # In the hello or on_open, try again like for a lost
+                    # connection
+                    print('Communication failed: {!r}'.format(e))
+                    abort(client)
+                else:
+                    if client.name:
+                        # We got in, start over with short delays
+                        delay = klass.RECONNECT_MIN
+                previous = client
+
+            wait = random.uniform(0, delay)
+            print('Reconnecting in {:.1f} seconds'.format(wait))
+            yield from asyncio.sleep(wait)
+            delay = min(delay * 2, klass.RECONNECT_MAX)
+    finally:
+        if client is not None:
+            # Every client took over the worker threads of the one before
+            client.executor.shutdown(wait=False)
 
-        return args, kwargs
 
 if __name__ == '__main__':
     print("Starting client")
 
     @asyncio.coroutine
     def handle():
-        client = yield from websockets.connect(
-            'ws://localhost:8900', klass=Client)
-        yield from client.communicate()
+        yield from run('ws://localhost:8900', klass=Client)
     try:
         asyncio.get_event_loop().run_until_complete(handle())
     except KeyboardInterrupt:
@@ -0,0 +1,94 @@
+import asyncio
+import websockets
+
+# Weights of the smoothed round trip time and its variation, as TCP does
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+
+
+class Liveness(object):
+    """
+    Round trip times of a connection, measured with websocket pings, and
+    when to ping next.
+
+    A quiet, steady connection is pinged less and less often, up to
+    interval_max seconds apart. A pong that is late compared to the
+    earlier ones brings the interval back to interval_min, so a failing
+    peer is found quickly. A peer that does not answer a ping within
+    timeout seconds is dead.
+    """
+
+    GROWTH = 1.5
+
+    def __init__(self, interval_min=1, interval_max=10, timeout=5):
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.timeout = timeout
+        self.interval = interval_min
+        self.srtt = None
+        self.rttvar = None
+        self.last = None
+        self.min = None
+        self.max = None
+        self.count = 0
+        self.missed = 0
+
+    @property
+    def stats(self):
+        return {
+            'rtt': self.last,
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'min': self.min,
+            'max': self.max,
+            'pings': self.count,
+            'missed': self.missed,
+            'interval': self.interval,
+        }
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+            late = False
+        else:
+            late = rtt > self.srtt + 4 * self.rttvar
+            self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_ALPHA * (rtt - self.srtt)
+        self.last = rtt
+        self.min = rtt if self.min is None else min(self.min, rtt)
+        self.max = rtt if self.max is None else max(self.max, rtt)
+        self.count += 1
+        if late:
+            self.interval = self.interval_min
+        else:
+            self.interval = min(self.interval * self.GROWTH,
+                                self.interval_max)
+
+    @asyncio.coroutine
+    def ping(self, protocol):
+        """Ping the peer, return False if it is gone"""
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            waiter = yield from protocol.ping()
+            yield from asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            self.missed += 1
+            return False
+        except websockets.InvalidState:
+            # Closed already
+            return False
+        self.sample(loop.time() - start)
+        return True
+
+
+def abort(protocol):
+    """
+    Drop the connection of a websocket protocol right away. A dead peer
+    would not answer the closing handshake.
+    """
+    transport = getattr(protocol, 'transport', None)
+    if transport is None:
+        transport = protocol.writer.transport
+    transport.abort()
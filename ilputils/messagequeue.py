@@ -0,0 +1,97 @@
+import asyncio
+import collections
+
+NORMAL = 0
+URGENT = 1
+
+
+class QueueClosed(Exception):
+    pass
+
+
+def is_urgent(message):
+    return (isinstance(message, dict) and
+            message.get('priority', NORMAL) > NORMAL)
+
+
+class MessageQueue(object):
+    """
+    Drop-in for the deque of messages, with a lane for urgent messages.
+
+    Messages with a priority above NORMAL jump ahead of all normal messages,
+    but keep their order among themselves. Consumers wait for messages with
+    get(), which raises QueueClosed once the queue is closed and empty.
+    While the queue is paused get() only hands out urgent messages.
+    """
+
+    def __init__(self, items=()):
+        self._urgent = collections.deque()
+        self._normal = collections.deque()
+        self._event = None
+        self.closed = False
+        self.paused = False
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self._urgent) + len(self._normal)
+
+    def __iter__(self):
+        yield from self._urgent
+        yield from self._normal
+
+    def append(self, item):
+        if is_urgent(item):
+            self._urgent.append(item)
+        else:
+            self._normal.append(item)
+        self._wake()
+
+    def appendleft(self, item):
+        if is_urgent(item):
+            self._urgent.appendleft(item)
+        else:
+            self._normal.appendleft(item)
+        self._wake()
+
+    def popleft(self):
+        if self._urgent:
+            return self._urgent.popleft()
+        return self._normal.popleft()
+
+    def clear(self):
+        self._urgent.clear()
+        self._normal.clear()
+
+    @asyncio.coroutine
+    def get(self):
+        while not (self._urgent or self._normal and not self.paused):
+            if self.closed and not self:
+                raise QueueClosed()
+            if self._event is None:
+                # Created here, so the queue can be made outside the loop
+                self._event = asyncio.Event()
+            self._event.clear()
+            yield from self._event.wait()
+        return self.popleft()
+
+    def pause(self):
+        """Hold back the normal messages, until resume()"""
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._wake()
+
+    def close(self):
+        """Wake the consumers, get() raises QueueClosed once empty"""
+        self.closed = True
+        self._wake()
+
+    def reopen(self):
+        """Hand out messages again, to the consumers of a new connection"""
+        self.closed = False
+
+    def _wake(self):
+        if self._event is not None:
+            self._event.set()
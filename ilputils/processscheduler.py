@@ -0,0 +1,191 @@
+import ctypes
+import json
+import multiprocessing
+import struct
+
+from .ring import LENGTH, Ring
+from .schedulers import ILPScheduler, LedsSchedule, monotonic_ns, now_ns
+from .waveforms import from_description
+from .wire import from_mask, to_mask
+
+KIND = struct.Struct('<B')
+KIND_ENTRIES = 0
+KIND_WAVE = 1
+KIND_CLEAR = 2
+KIND_STOP = 3
+KIND_CLOCK = 4
+
+# Overwrite flag, then entries of nanoseconds, LED mask, color, intensity
+OVERWRITE = struct.Struct('<?')
+ENTRY = struct.Struct('<qBif')
+# Deadline and tick time in nanoseconds, led, intensity
+FRAME = struct.Struct('<qqBf')
+
+RING_SIZE = 2 ** 20
+# Entries per message, so a message always fits in the ring
+CHUNK = 4096
+
+
+class SchedulerFull(Exception):
+    """The scheduler process does not keep up, nothing was sent"""
+
+
+class ProcessScheduler(object):
+    """
+    ILPScheduler in a process of its own, so the event loop of the client
+    does not take turns with it for the GIL.
+
+    Drop-in for ILPScheduler: schedules go to the process through a shared
+    memory Ring, frames it played come back through another one, see
+    frames(). The process keeps its own copy of the clock, its offset from
+    the monotonic clock is handed over with every command and by
+    sync_clock().
+    """
+
+    def __init__(self, default_color=0xFFFFFF, default_intensity=192,
+                 clock=now_ns, klass=ILPScheduler, ring_size=RING_SIZE,
+                 snapshot=None):
+        self.clock = clock
+        # Spawn, the client has threads that a fork would copy half of
+        context = multiprocessing.get_context('spawn')
+        self._commands = Ring(ring_size, context)
+        self._frames = Ring(ring_size, context)
+        self._wakeup = context.Event()
+        self._ready = context.Event()
+        # With a lock, a 64 bit store is not atomic on every CPU
+        self._offset = context.Value(ctypes.c_int64, self._clock_offset())
+        self._process = context.Process(
+            target=serve, daemon=True,
+            args=(self._commands, self._frames, self._wakeup, self._ready,
+                  self._offset, klass, default_color, default_intensity,
+                  snapshot))
+
+    def start(self):
+        self._process.start()
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def wait_ready(self, timeout=None):
+        """
+        Block until the process plays, spawning it takes a while. False if
+        it did not start within timeout seconds.
+        """
+        return self._ready.wait(timeout)
+
+    def stop(self):
+        if self.is_alive():
+            self._send(KIND.pack(KIND_STOP))
+
+    def clear(self):
+        """Forget everything that is scheduled"""
+        self._send(KIND.pack(KIND_CLEAR))
+
+    def sync_clock(self):
+        """The clock was adjusted, have the process follow it right away"""
+        self._offset.value = self._clock_offset()
+        try:
+            # Wakes the scheduler to measure its wait on the new clock
+            self._send(KIND.pack(KIND_CLOCK))
+        except SchedulerFull:
+            # It has the offset, and commands to get to first
+            pass
+
+    def add(self, schedule, overwrite=False):
+        self.add_batch([schedule], overwrite)
+
+    def add_batch(self, schedules, overwrite=False):
+        messages = []
+        for start in range(0, len(schedules), CHUNK):
+            entries = [
+                ENTRY.pack(schedule.time, to_mask(schedule.leds),
+                           schedule.color, schedule.intensity)
+                for schedule in schedules[start:start + CHUNK]]
+            messages.append(b''.join([KIND.pack(KIND_ENTRIES),
+                                      OVERWRITE.pack(overwrite)] + entries))
+        self._send(*messages)
+
+    def add_wave(self, wave):
+        self._send(KIND.pack(KIND_WAVE) +
+                   json.dumps(wave.description).encode('utf8'))
+
+    def frames(self):
+        """
+        The frames played since the last call, as (deadline, played, led,
+        intensity) with times in nanoseconds. Without calls the ring fills
+        up and the newer frames are not reported.
+        """
+        return [FRAME.unpack(data) for data in self._frames]
+
+    def _clock_offset(self):
+        return self.clock() - monotonic_ns()
+
+    def _send(self, *messages):
+        """
+        Put messages in the ring, all or none of them. Never waits, we run
+        on the event loop of the client.
+        """
+        if self._process.exitcode is not None:
+            raise SchedulerFull('The scheduler process is gone')
+        if sum(LENGTH.size + len(data) for data in messages) > \
+                self._commands.free():
+            raise SchedulerFull('The scheduler process does not keep up')
+        self._offset.value = self._clock_offset()
+        for data in messages:
+            # We are the only one to put, so there is room
+            self._commands.put(data)
+        self._wakeup.set()
+
+
+def serve(commands, frames, wakeup, ready, offset, klass, default_color,
+          default_intensity, snapshot=None):
+    """Run a scheduler on the commands of a ProcessScheduler"""
+    def clock():
+        return monotonic_ns() + offset.value
+
+    def report(now, settings):
+        for led in (0, 1):
+            setting = settings.get('led{}'.format(led))
+            if setting is not None:
+                frames.put(FRAME.pack(setting['time'], now, led,
+                                      setting['intensity']))
+
+    scheduler = klass(default_color, default_intensity, clock=clock,
+                      snapshot=snapshot)
+    scheduler.on_played = report
+    scheduler.start()
+    ready.set()
+    while True:
+        wakeup.wait()
+        wakeup.clear()
+        for data in commands:
+            try:
+                kind = handle_command(scheduler, data)
+            except Exception as e:
+                # The process lives on, the client has no other way to
+                # play its schedules
+                print('Scheduler command failed: {!r}'.format(e))
+                continue
+            if kind == KIND_STOP:
+                return
+
+
+def handle_command(scheduler, data):
+    """Apply a command to the scheduler, returns the kind of command"""
+    kind = KIND.unpack_from(data)[0]
+    if kind == KIND_ENTRIES:
+        overwrite = OVERWRITE.unpack_from(data, KIND.size)[0]
+        scheduler.add_batch([
+            LedsSchedule(from_mask(mask), ns, color, intensity)
+            for ns, mask, color, intensity in ENTRY.iter_unpack(
+                data[KIND.size + OVERWRITE.size:])], overwrite)
+    elif kind == KIND_WAVE:
+        scheduler.add_wave(from_description(
+            json.loads(data[KIND.size:].decode('utf8'))))
+    elif kind == KIND_CLEAR:
+        scheduler.clear()
+    elif kind == KIND_CLOCK:
+        scheduler.sync_clock()
+    elif kind == KIND_STOP:
+        scheduler.stop()
+    return kind
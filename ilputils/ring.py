@@ -0,0 +1,89 @@
+import ctypes
+import multiprocessing
+import struct
+
+LENGTH = struct.Struct('<I')
+HEAD = 0
+TAIL = 1
+
+
+class Ring(object):
+    """
+    Ring buffer of byte messages in shared memory, for one process that
+    puts and one that gets.
+
+    Head and tail are counters that only grow, the putting side only
+    moves the tail and the getting side only the head. A message is
+    written before the tail moves past it, so the other side never sees
+    half a message. The counters are read and written under a lock: its
+    acquire and release are the memory barriers that keep the message
+    ahead of the counter on CPUs that reorder stores, like the ARM of a
+    Raspberry Pi, and they make the 64 bit counters atomic on 32 bit ones.
+    The lock is never held while a message is copied, so neither side
+    waits for more than the other reading or writing a counter. Pass the
+    ring to the other process when it is created.
+    """
+
+    def __init__(self, size=2 ** 20, context=multiprocessing):
+        self.size = size
+        self._counters = context.RawArray(ctypes.c_uint64, 2)
+        self._buffer = context.RawArray(ctypes.c_char, size)
+        self._lock = context.Lock()
+
+    def __len__(self):
+        """Bytes in use"""
+        head, tail = self._load()
+        return tail - head
+
+    def free(self):
+        """Bytes of messages that fit right now, with their lengths"""
+        return self.size - len(self)
+
+    def put(self, data):
+        """Add a message, False if it does not fit right now"""
+        record = LENGTH.pack(len(data)) + data
+        head, tail = self._load()
+        if tail + len(record) - head > self.size:
+            return False
+        self._write(tail % self.size, record)
+        self._store(TAIL, tail + len(record))
+        return True
+
+    def get(self):
+        """Take the oldest message, None if there is none"""
+        head, tail = self._load()
+        if head == tail:
+            return None
+        length = LENGTH.unpack(self._read(head % self.size, LENGTH.size))[0]
+        data = self._read((head + LENGTH.size) % self.size, length)
+        self._store(HEAD, head + LENGTH.size + length)
+        return data
+
+    def __iter__(self):
+        """Take the messages there are now"""
+        while True:
+            data = self.get()
+            if data is None:
+                return
+            yield data
+
+    def _load(self):
+        with self._lock:
+            return self._counters[HEAD], self._counters[TAIL]
+
+    def _store(self, index, value):
+        with self._lock:
+            self._counters[index] = value
+
+    def _write(self, offset, data):
+        first = min(len(data), self.size - offset)
+        self._buffer[offset:offset + first] = data[:first]
+        if first < len(data):
+            self._buffer[:len(data) - first] = data[first:]
+
+    def _read(self, offset, length):
+        first = min(length, self.size - offset)
+        data = self._buffer[offset:offset + first]
+        if first < length:
+            data += self._buffer[:length - first]
+        return data
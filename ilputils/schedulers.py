@@ -1,27 +1,64 @@
 #!/usr/bin/env python
 
+import asyncio
+import bisect
+import heapq
+import itertools
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from threading import Thread
+from threading import Condition, Thread
 
 from .pwm import print_pin, set_pins
+from .snapshot import Snapshot
+from .wire import from_mask, to_mask
 
 DEFAULT = -1
 MAX_INTENSITY = 255
+ALL_LEDS = (0, 1)
+
+# Times are integer nanoseconds since the epoch (UTC), datetimes are only
+# taken and given at the edges
+SECOND = 10 ** 9
+EPOCH = datetime(1970, 1, 1)
+# now_ns() follows the monotonic clock from where the wall clock was at start
+_MONOTONIC_BASE = time.time() - time.monotonic()
+
+
+def to_ns(time):
+    """Nanoseconds since the epoch of a UTC datetime, ints pass as they are"""
+    if isinstance(time, datetime):
+        return (time - EPOCH) // timedelta(microseconds=1) * 1000
+    return time
+
+
+def from_ns(ns):
+    return EPOCH + timedelta(microseconds=ns // 1000)
+
+
+def monotonic_ns():
+    return int(time.monotonic() * SECOND)
+
+
+def now_ns():
+    return int((_MONOTONIC_BASE + time.monotonic()) * SECOND)
 
 
 class LedsSchedule(object):
+    __slots__ = ('leds', 'time', 'color', 'intensity')
+
     def __init__(self, leds=None, start_time=None, color=DEFAULT,
                  intensity=DEFAULT):
         if isinstance(leds, (tuple, list)):
             self.leds = leds
         elif leds is None:
-            self.leds = [0, 1]
+            self.leds = ALL_LEDS
         else:
-            self.leds = [leds]
+            self.leds = (leds, )
 
-        assert isinstance(start_time, datetime), 'Time must be a datetime object'
-        self.time = start_time
+        assert isinstance(start_time, (datetime, int)), \
+            'Time must be a datetime or nanoseconds since the epoch'
+        self.time = to_ns(start_time)
 
         assert DEFAULT <= color <= 0xFFFFFF, \
             'Color must be between {} and 0xFFFFFF, got {}'.format(DEFAULT,
@@ -36,13 +73,61 @@ class LedsSchedule(object):
     @property
     def settings(self):
         return {
+            'time': self.time,
             'color': self.color,
             'intensity': self.intensity
         }
 
     @property
     def array_settings(self):
-        return [str(self.time), self.leds, self.color, self.intensity]
+        return [str(from_ns(self.time)), self.leds, self.color,
+                self.intensity]
+
+
+class Timeline(object):
+    """
+    Values that take effect at a time, in time order for bisect.
+
+    Values of the same time keep the order they were added in, the last one
+    wins. expire() forgets values that can no longer be the answer, but only
+    moves an index; the lists are cut when half of them is expired.
+    """
+
+    def __init__(self):
+        self._times = []
+        self._values = []
+        self._head = 0
+
+    def __len__(self):
+        return len(self._times) - self._head
+
+    def __iter__(self):
+        return zip(self._times[self._head:], self._values[self._head:])
+
+    def add(self, time, value):
+        if not self._times or time >= self._times[-1]:
+            # Schedules mostly come in time order
+            index = len(self._times)
+        else:
+            index = bisect.bisect_right(self._times, time, self._head)
+        self._times.insert(index, time)
+        self._values.insert(index, value)
+
+    def get(self, time):
+        """The last value that took effect before time, None if none did"""
+        index = bisect.bisect_left(self._times, time, self._head) - 1
+        if index >= self._head:
+            return self._values[index]
+
+    def expire(self, time):
+        """Forget what is not needed to answer get() for time or later"""
+        index = bisect.bisect_left(self._times, time, self._head) - 1
+        if index > self._head:
+            self._head = index
+            if self._head > len(self._times) // 2:
+                del self._times[:self._head]
+                del self._values[:self._head]
+                self._head = 0
 
 
 class DefaultValueSchedule(object):
@@ -51,113 +136,287 @@ class DefaultValueSchedule(object):
     Maintains a schedule of future default values.
 
     The schedule may change anytime so default values should not be resolved
-    with get() until execution
+    with get() until execution. Colors and intensities are kept in separate
+    timelines, so both lookups are a bisect.
     """
 
-    def __init__(self, items=None):
-        self._items = []
+    def __init__(self, items=None, clock=now_ns):
+        self._clock = clock
+        self._colors = Timeline()
+        self._intensities = Timeline()
         self.items = [] if items is None else items
 
     @property
     def items(self):
-        return self._items
+        items = [LedsSchedule(start_time=time, color=color)
+                 for time, color in self._colors]
+        items.extend(LedsSchedule(start_time=time, intensity=intensity)
+                     for time, intensity in self._intensities)
+        return sorted(items, key=lambda x: x.time)
 
     @items.setter
     def items(self, items):
         for item in items:
             assert isinstance(item, LedsSchedule), 'Only LedsSchedule allowed'
-        self._items = items
+        self._colors = Timeline()
+        self._intensities = Timeline()
+        for item in items:
+            self.add(item.time, item.color, item.intensity)
+
+    def add(self, start_time, color=DEFAULT, intensity=DEFAULT):
+        start_time = to_ns(start_time)
+        if color != DEFAULT:
+            self._colors.add(start_time, color)
+        if intensity != DEFAULT:
+            self._intensities.add(start_time, intensity)
 
-    def add(self, start_datetime, color=DEFAULT, intensity=DEFAULT):
-        self._items.append(LedsSchedule(start_time=start_datetime, color=color,
-                                        intensity=intensity))
-        self._items = sorted(
-            (i for i in self._items if i.time >= datetime.utcnow()),
-            key=lambda x: x.time)
+    def expire(self, now=None):
+        """Forget the values that were replaced before now"""
+        if now is None:
+            now = self._clock()
+        self._colors.expire(now)
+        self._intensities.expire(now)
 
     def get_color(self, time):
-        for item in reversed(self._items):
-            if time > item.time and item.color != DEFAULT:
-                return item.color
+        return self._colors.get(to_ns(time))
 
     def get_intensity(self, time):
-        for item in reversed(self._items):
-            if time > item.time and item.intensity != DEFAULT:
-                return item.intensity
+        return self._intensities.get(to_ns(time))
+
 
+class BaseScheduler(object):
+    """
+    Schedules and waves to play, without a way to wait for them.
+
+    The schedules wait in a heap on their time. While a wave (see
+    waveforms) runs, its leds follow it every TIMEGRANULARITY. Subclasses
+    call _play() when _wait() says so.
 
-class ILPScheduler(Thread):
-    """Scheduler in a separate thread"""
+    With a snapshot path the schedules and waves are kept in a Snapshot as
+    well, and what was pending there when the scheduler was made is played
+    on. The schedules are read from the file as they become due.
+    """
 
     TIMEGRANULARITY = 1 / 50  # Eye detection limit; avoid 50 Hz
 
-    def __init__(self, default_color=0xFFFFFF, default_intensity=192):
-        super(ILPScheduler, self).__init__()
+    def __init__(self, default_color=0xFFFFFF, default_intensity=192,
+                 clock=now_ns, snapshot=None):
+        # Gives the current time in nanoseconds since the epoch, pass a
+        # synchronized clock to agree on the time with other actuators
+        self.clock = clock
+        # Heap of (time, order added, schedule)
         self._items = []
-        self._max_datetime = datetime.utcnow()
-        self._default = DefaultValueSchedule()
+        self._counter = itertools.count()
+        self._max_time = self.clock()
+        self._default = DefaultValueSchedule(clock=clock)
+        # Waves, with the intensity they last set
+        self._waves = []
         self._DEFAULT_COLOR = default_color
         self._DEFAULT_INTENSITY = default_intensity
         self.running = False
+        # Called with the time of the tick and the settings it played
+        self.on_played = None
+        self._snapshot = None
+        # Pending sorted schedules of the snapshot, not in the heap yet
+        self._backlog = None
+        if snapshot is not None:
+            self._snapshot = Snapshot(snapshot)
+            self._restore()
 
-    def run(self):
-        self.running = True
+    def get(self):
+        if self._backlog is not None:
+            for record in self._backlog.take(float('inf')):
+                self._push(_from_record(record))
+        return [item for _, _, item in sorted(self._items)]
+
+    def clear(self):
+        """Forget everything that is scheduled"""
+        self._items = []
+        self._waves = []
+        self._backlog = None
+        self._default = DefaultValueSchedule(clock=self.clock)
+        self._max_time = self.clock()
+        if self._snapshot is not None:
+            self._snapshot.clear(self._max_time)
+
+    def add(self, schedule, overwrite=False):
+        self.add_batch([schedule], overwrite)
+
+    def add_batch(self, schedules, overwrite=False):
+        """Add schedules in one go, as if added one by one in this order"""
+        now = self.clock()
+        added = []
+        for schedule in schedules:
+            assert isinstance(schedule, LedsSchedule)
+            if schedule.time < now or (
+                    schedule.time < self._max_time and not overwrite):
+                continue
+            self._push(schedule)
+            added.append(schedule)
+        if self._snapshot is not None and added:
+            self._snapshot.add([_to_record(schedule) for schedule in added])
+
+    def sync_clock(self):
+        """The clock was adjusted, what waits for it should measure again"""
+
+    def add_wave(self, wave):
+        """Have the leds of wave follow it, from its start to its end"""
+        if wave.end < self.clock():
+            return
+        self._waves.append([wave, None])
+        self._save_waves()
+
+    def _push(self, schedule):
+        heapq.heappush(self._items,
+                       (schedule.time, next(self._counter), schedule))
+        self._max_time = max(self._max_time, schedule.time)
+        self._default.add(schedule.time, schedule.color, schedule.intensity)
+
+    def _save_waves(self):
+        if self._snapshot is not None:
+            self._snapshot.save_waves(
+                [wave.description for wave, _ in self._waves])
+
+    def _restore(self):
+        # Waves describe themselves in terms of the scheduler
+        from .waveforms import from_description
+        now = self.clock()
+        for description in self._snapshot.load_waves():
+            try:
+                wave = from_description(description)
+            except ValueError as e:
+                print('Not restoring wave {}: {}'.format(description, e))
+                continue
+            if wave.end >= now:
+                self._waves.append([wave, None])
+        backlog, tail, played, color, intensity = self._snapshot.load()
+        if not backlog and not tail:
+            return
+        # The defaults in effect when we stopped, for what comes after
+        self._default.add(played - 1, color, intensity)
+        for record in tail:
+            self._push(_from_record(record))
+        if backlog:
+            self._backlog = backlog
+            self._max_time = max(self._max_time, backlog.last())
+
+    def _start_default(self):
+        if self._items or self._backlog is not None or self._waves:
+            # Restored, the leds carry on with that
+            return
         self.add(
-            LedsSchedule(start_time=datetime.utcnow() + timedelta(seconds=0.5),
+            LedsSchedule(start_time=self.clock() + SECOND // 2,
                          color=self._DEFAULT_COLOR,
                          intensity=self._DEFAULT_INTENSITY))
-        while self.running:
-            tstart = time.time()
-            self._set_changes(self._get_changed_settings())
-            sleep_time = self.TIMEGRANULARITY - time.time() + tstart
-            if sleep_time > 0:
-                time.sleep(sleep_time)
 
-    def get(self):
-        return self._items
+    def _next_start(self):
+        """Time of the first schedule or wave, None without any"""
+        starts = [wave.start for wave, _ in self._waves]
+        if self._items:
+            starts.append(self._items[0][0])
+        if self._backlog is not None and self._backlog:
+            starts.append(self._backlog.peek())
+        if not starts:
+            return None
+        return min(starts)
 
-    def add(self, schedule, overwrite=False):
-        assert isinstance(schedule, LedsSchedule)
-        now = datetime.utcnow()
-        if schedule.time < now or (
-                schedule.time < self._max_datetime and not overwrite):
-            return
-        self._items.append(schedule)
-        self._max_datetime = max(self._max_datetime, schedule.time)
-        if schedule.color != DEFAULT and schedule.intensity != DEFAULT:
-            self._default.add(schedule.time, schedule.color,
-                              schedule.intensity)
-        elif schedule.color != DEFAULT:
-            self._default.add(schedule.time, schedule.color)
-        elif schedule.intensity != DEFAULT:
-            self._default.add(schedule.time, intensity=schedule.intensity)
-        self._items.sort(key=lambda x: x.time)
-
-    def _get_changed_settings(self):
-        tb_executed = []
-        for item in self._items:
-            if item.time < datetime.utcnow():
-                if item.color == DEFAULT:
-                    color = self._default.get_color(item.time)
-                    if color is None:
-                        color = self._DEFAULT_COLOR
-                    item.color = color
-                if item.intensity == DEFAULT:
-                    intensity = self._default.get_intensity(item.time)
-                    if intensity is None:
-                        intensity = self._DEFAULT_INTENSITY
-                    item.intensity = intensity
-                tb_executed.append(item)
-                self._items.remove(item)
+    def _until_next(self, now):
+        """Seconds from now until the first schedule, None without any"""
+        start = self._next_start()
+        if start is None:
+            return None
+        return max((start - now) / SECOND,
+                   self.TIMEGRANULARITY if self._waves else 0)
+
+    def _wait(self, now, settings, elapsed):
+        """Seconds to wait after a tick at now, None for until woken"""
+        wait = self._until_next(now)
+        if wait is not None:
+            wait -= elapsed
+        if settings:
+            # Do not change the leds faster than the eye can see
+            wait = max(wait or 0, self.TIMEGRANULARITY - elapsed)
+        return wait
+
+    def _play(self, now):
+        settings = self._get_changed_settings(now)
+        if settings:
+            self._set_changes(settings)
+            if self.on_played is not None:
+                self.on_played(now, settings)
+        return settings
+
+    def _pop_due(self, now):
+        if self._backlog is not None:
+            for record in self._backlog.take(now):
+                self._push(_from_record(record))
+        due = []
+        while self._items and self._items[0][0] < now:
+            due.append(heapq.heappop(self._items)[2])
+        return due
+
+    def _get_changed_settings(self, now=None):
+        if now is None:
+            now = self.clock()
+        tb_executed = self._pop_due(now)
+        self._resolve_defaults(tb_executed)
+        # What is left starts from now, it needs no older defaults
+        self._default.expire(now)
+        waves = self._wave_settings(now)
+        if self._snapshot is not None and tb_executed:
+            color = self._default.get_color(now)
+            intensity = self._default.get_intensity(now)
+            self._snapshot.played(
+                now, DEFAULT if color is None else color,
+                DEFAULT if intensity is None else intensity)
 
         settings = {}
-        for item in tb_executed:
+        for item in tb_executed + waves:
             if 0 in item.leds:
                 settings['led0'] = item.settings
             if 1 in item.leds:
                 settings['led1'] = item.settings
         return settings
 
+    def _wave_settings(self, now):
+        """Running waves as LedsSchedules, if their intensity changed"""
+        settings = []
+        ended = False
+        for entry in list(self._waves):
+            wave, last = entry
+            if wave.start > now:
+                continue
+            if now >= wave.end:
+                # Ends on its final value
+                self._waves.remove(entry)
+                ended = True
+            intensity = wave.intensity_at(now)
+            if intensity == last:
+                continue
+            entry[1] = intensity
+            color = wave.color
+            if color == DEFAULT:
+                color = self._default.get_color(now)
+                if color is None:
+                    color = self._DEFAULT_COLOR
+            settings.append(LedsSchedule(wave.leds, now, color, intensity))
+        if ended:
+            self._save_waves()
+        return settings
+
+    def _resolve_defaults(self, tb_executed):
+        for item in tb_executed:
+            if item.color == DEFAULT:
+                color = self._default.get_color(item.time)
+                if color is None:
+                    color = self._DEFAULT_COLOR
+                item.color = color
+            if item.intensity == DEFAULT:
+                intensity = self._default.get_intensity(item.time)
+                if intensity is None:
+                    intensity = self._DEFAULT_INTENSITY
+                item.intensity = intensity
+
     def _set_changes(self, settings):
         led0 = settings.get('led0')
         led1 = settings.get('led1')
@@ -171,3 +430,171 @@ class ILPScheduler(Thread):
             cmds.append([24, led1['intensity'] / MAX_INTENSITY])
 
         set_pins(cmds)
+
+
+class ILPScheduler(BaseScheduler, Thread):
+    """
+    Scheduler in a separate thread.
+
+    The thread sleeps until the first schedule is due or until add() brings
+    an earlier one.
+    """
+
+    def __init__(self, default_color=0xFFFFFF, default_intensity=192,
+                 clock=now_ns, snapshot=None):
+        Thread.__init__(self)
+        BaseScheduler.__init__(self, default_color, default_intensity, clock,
+                               snapshot)
+        # Outlives the connections of its client, but not the program
+        self.daemon = True
+        # Guards the schedules, the thread waits on it
+        self._condition = Condition()
+
+    def run(self):
+        self.running = True
+        self._start_default()
+        while self.running:
+            # The only clock read of a tick
+            tstart = time.monotonic()
+            now = self.clock()
+            try:
+                settings = self._play(now)
+            except Exception as e:
+                print('Scheduler tick failed: {!r}'.format(e))
+                settings = None
+            with self._condition:
+                if not self.running:
+                    break
+                if settings is None:
+                    # Again a frame later, rather than spinning on it
+                    wait = self.TIMEGRANULARITY
+                else:
+                    wait = self._wait(now, settings,
+                                      time.monotonic() - tstart)
+                if wait is None or wait > 0:
+                    self._condition.wait(wait)
+
+    def stop(self):
+        with self._condition:
+            self.running = False
+            self._condition.notify()
+
+    def sync_clock(self):
+        with self._condition:
+            self._condition.notify()
+
+    def get(self):
+        with self._condition:
+            return super(ILPScheduler, self).get()
+
+    def clear(self):
+        with self._condition:
+            super(ILPScheduler, self).clear()
+
+    def add_batch(self, schedules, overwrite=False):
+        with self._condition:
+            first = self._next_start()
+            super(ILPScheduler, self).add_batch(schedules, overwrite)
+            self._wake(first)
+
+    def add_wave(self, wave):
+        with self._condition:
+            first = self._next_start()
+            super(ILPScheduler, self).add_wave(wave)
+            self._wake(first)
+
+    def _wake(self, first):
+        start = self._next_start()
+        if start is not None and (first is None or start < first):
+            # Earlier than what the thread sleeps for
+            self._condition.notify()
+
+    def _get_changed_settings(self, now=None):
+        with self._condition:
+            return super(ILPScheduler, self)._get_changed_settings(now)
+
+
+class LoopScheduler(BaseScheduler):
+    """
+    Scheduler on an asyncio event loop, with a timer for the first
+    schedule. Nothing runs while nothing is scheduled, and everything runs
+    on the thread of the loop, so there is nothing to lock. Only the pins
+    are set in a worker thread, one command after the other, as that forks
+    a shell.
+    """
+
+    def __init__(self, default_color=0xFFFFFF, default_intensity=192,
+                 clock=now_ns, loop=None, snapshot=None):
+        super(LoopScheduler, self).__init__(default_color, default_intensity,
+                                            clock, snapshot)
+        self._loop = asyncio.get_event_loop() if loop is None else loop
+        self._timer = None
+        self._pins = ThreadPoolExecutor(1)
+
+    def start(self):
+        self.running = True
+        self._start_default()
+        self._reschedule()
+
+    def is_alive(self):
+        return self.running
+
+    def stop(self):
+        self.running = False
+        self._reschedule()
+
+    def sync_clock(self):
+        self._reschedule()
+
+    def clear(self):
+        super(LoopScheduler, self).clear()
+        self._reschedule()
+
+    def add_batch(self, schedules, overwrite=False):
+        super(LoopScheduler, self).add_batch(schedules, overwrite)
+        self._reschedule()
+
+    def add_wave(self, wave):
+        super(LoopScheduler, self).add_wave(wave)
+        self._reschedule()
+
+    def _reschedule(self, wait=None):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.running:
+            return
+        if wait is None:
+            wait = self._until_next(self.clock())
+        if wait is not None:
+            self._timer = self._loop.call_at(self._loop.time() + max(wait, 0),
+                                             self._tick)
+
+    def _tick(self):
+        self._timer = None
+        tstart = self._loop.time()
+        now = self.clock()
+        try:
+            settings = self._play(now)
+        except Exception as e:
+            print('Scheduler tick failed: {!r}'.format(e))
+            # Again a frame later, rather than spinning on it
+            self._reschedule(self.TIMEGRANULARITY)
+            return
+        wait = self._wait(now, settings, self._loop.time() - tstart)
+        if wait is not None:
+            self._reschedule(wait)
+
+    def _set_changes(self, settings):
+        self._loop.run_in_executor(
+            self._pins, super(LoopScheduler, self)._set_changes, settings)
+
+
+def _to_record(schedule):
+    return (schedule.time, to_mask(schedule.leds), schedule.color,
+            schedule.intensity)
+
+
+def _from_record(record):
+    time, mask, color, intensity = record
+    return LedsSchedule(from_mask(mask), time, color, intensity)
@@ -0,0 +1,215 @@
+import json
+import mmap
+import os
+import struct
+
+# Magic, records in the sorted run, records in total, time played up to in
+# nanoseconds, and the default color and intensity in effect then
+HEADER = struct.Struct('<8sQQqif')
+HEADER_SIZE = 64
+MAGIC = b'ILPSNAP1'
+# Nanoseconds since the epoch, LED mask, color, intensity
+RECORD = struct.Struct('<qBif')
+
+# Records the file has room for at first, it doubles when full
+CAPACITY = 4096
+# Unsorted records kept before they are merged into the sorted run, which
+# bounds the work of opening the file
+TAIL_MAX = 1024
+
+
+class Backlog(object):
+    """
+    The sorted records of a snapshot that are still to come, read from the
+    file as they become due instead of all at once.
+    """
+
+    def __init__(self, buffer, index, stop):
+        # Keeps its own reference, the snapshot may move to a new file
+        self._buffer = buffer
+        self._index = index
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._index
+
+    def peek(self):
+        """Time of the next record, None if there are no more"""
+        if self._index < self._stop:
+            return _time(self._buffer, self._index)
+
+    def last(self):
+        if self._index < self._stop:
+            return _time(self._buffer, self._stop - 1)
+
+    def take(self, time):
+        """The records before time"""
+        records = []
+        while self._index < self._stop:
+            record = _record(self._buffer, self._index)
+            if record[0] >= time:
+                break
+            records.append(record)
+            self._index += 1
+        return records
+
+
+class Snapshot(object):
+    """
+    The pending schedule of an actuator in a memory mapped file, so it
+    survives a restart of the client.
+
+    Records of (time, LED mask, color, intensity) are appended as they are
+    added. While they come in time order, as they do unless overwritten,
+    they extend a sorted run; others go to a tail that is merged into the
+    run when it grows past TAIL_MAX. Played records are not removed, the
+    header keeps the time played up to. Opening bisects the run for the
+    first pending record and reads only the tail, so it takes as long for
+    a hundred pending records as for a million.
+
+    Waves are few and small, their descriptions are kept next to the file,
+    in path + '.waves', and written anew whenever one starts or ends.
+
+    Writes go to the page cache, they survive the process but not the
+    machine going down.
+    """
+
+    def __init__(self, path, capacity=CAPACITY):
+        self.path = path
+        self.waves_path = path + '.waves'
+        self._file = None
+        self._buffer = None
+        if os.path.exists(path) and os.path.getsize(path) > HEADER_SIZE:
+            self._map(path)
+            if self._header()[0] != MAGIC:
+                print('Not a schedule snapshot, starting over: {}'.format(
+                    path))
+                self._write([], capacity, 0, -1, -1)
+        else:
+            self._write([], capacity, 0, -1, -1)
+
+    @property
+    def capacity(self):
+        return (len(self._buffer) - HEADER_SIZE) // RECORD.size
+
+    def load(self):
+        """
+        What to restore: a Backlog of the sorted run, the pending records
+        of the tail, the time played up to, and the default color and
+        intensity in effect then
+        """
+        _, run, count, played, color, intensity = self._header()
+        backlog = Backlog(self._buffer, self._first_pending(run, played), run)
+        tail = [record for record in (_record(self._buffer, index)
+                                      for index in range(run, count))
+                if record[0] >= played]
+        return backlog, tail, played, color, intensity
+
+    def add(self, records):
+        """Append records, in the order they were added to the schedule"""
+        _, run, count, played, color, intensity = self._header()
+        if count + len(records) > self.capacity:
+            run, count = self.compact(len(records))
+        for record in records:
+            if run == count and (not run or
+                                 record[0] >= _time(self._buffer, run - 1)):
+                run += 1
+            RECORD.pack_into(self._buffer, _offset(count), *record)
+            count += 1
+        # The records are written before the header counts them
+        self._pack(run, count, played, color, intensity)
+        if count - run > TAIL_MAX:
+            self.compact()
+
+    def played(self, time, color, intensity):
+        """Everything before time has been played"""
+        _, run, count, _, _, _ = self._header()
+        self._pack(run, count, time, color, intensity)
+
+    def clear(self, time):
+        self._pack(0, 0, time, -1, -1)
+        self.save_waves([])
+
+    def load_waves(self):
+        """The descriptions of the waves, see ilputils.waveforms"""
+        try:
+            with open(self.waves_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            print('Not a list of waves, starting without: {}'.format(
+                self.waves_path))
+            return []
+
+    def save_waves(self, descriptions):
+        temporary = self.waves_path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(descriptions, f)
+        os.replace(temporary, self.waves_path)
+
+    def compact(self, room=0):
+        """
+        Write the pending records to a new file, sorted, with room for more.
+        Returns the length of the run and the count of records.
+        """
+        _, run, count, played, color, intensity = self._header()
+        backlog, tail, _, _, _ = self.load()
+        # Stable, so records of the same time keep the order they came in
+        records = sorted(backlog.take(float('inf')) + tail,
+                         key=lambda record: record[0])
+        capacity = max(CAPACITY, 2 * (len(records) + room))
+        self._write(records, capacity, played, color, intensity)
+        return len(records), len(records)
+
+    def close(self):
+        self._buffer.close()
+        self._file.close()
+
+    def _first_pending(self, run, played):
+        low, high = 0, run
+        while low < high:
+            middle = (low + high) // 2
+            if _time(self._buffer, middle) < played:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _header(self):
+        return HEADER.unpack_from(self._buffer)
+
+    def _pack(self, run, count, played, color, intensity):
+        HEADER.pack_into(self._buffer, 0, MAGIC, run, count, played, color,
+                         intensity)
+
+    def _map(self, path):
+        self._file = open(path, 'r+b')
+        # A Backlog may still read the old mapping, it closes with the last
+        # reference to it
+        self._buffer = mmap.mmap(self._file.fileno(), 0)
+
+    def _write(self, records, capacity, played, color, intensity):
+        """Replace the file, a crash leaves either the old or the new one"""
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(records), len(records), played,
+                                color, intensity).ljust(HEADER_SIZE, b'\0'))
+            f.write(b''.join(RECORD.pack(*record) for record in records))
+            f.truncate(HEADER_SIZE + capacity * RECORD.size)
+        os.replace(temporary, self.path)
+        if self._file is not None:
+            self._file.close()
+        self._map(self.path)
+
+
+def _offset(index):
+    return HEADER_SIZE + index * RECORD.size
+
+
+def _record(buffer, index):
+    return RECORD.unpack_from(buffer, _offset(index))
+
+
+def _time(buffer, index):
+    return RECORD.unpack_from(buffer, _offset(index))[0]
@@ -0,0 +1,239 @@
+import bisect
+import math
+
+from .schedulers import DEFAULT, MAX_INTENSITY, SECOND, to_ns
+from .wire import from_mask, to_mask
+
+
+class Wave(object):
+    """
+    Intensity of leds as a function of the time since start.
+
+    A wave is sent as its description, a dict with the name of the wave,
+    start in epoch microseconds, an LED mask, the color and the parameters
+    of the wave, and evaluated by the scheduler of the actuator.
+    """
+
+    name = None
+
+    def __init__(self, start, leds=None, color=DEFAULT):
+        # A datetime or nanoseconds since the epoch
+        self.start = to_ns(start)
+        if isinstance(leds, (tuple, list)):
+            self.leds = leds
+        elif leds is None:
+            self.leds = [0, 1]
+        else:
+            self.leds = [leds]
+        if not DEFAULT <= color <= 0xFFFFFF:
+            raise ValueError('Color must be between {} and 0xFFFFFF, '
+                             'got {}'.format(DEFAULT, color))
+        self.color = color
+
+    @property
+    def duration(self):
+        raise NotImplementedError
+
+    @property
+    def end(self):
+        return self.start + int(self.duration * SECOND)
+
+    @property
+    def parameters(self):
+        raise NotImplementedError
+
+    @property
+    def description(self):
+        description = dict(self.parameters, wave=self.name,
+                           start=self.start // 1000,
+                           leds=to_mask(self.leds), color=self.color)
+        return description
+
+    def intensity(self, seconds):
+        """Intensity at seconds after start, within the duration"""
+        raise NotImplementedError
+
+    def intensity_at(self, time):
+        seconds = (time - self.start) / SECOND
+        seconds = min(max(seconds, 0), self.duration)
+        return min(max(self.intensity(seconds), 0), MAX_INTENSITY)
+
+
+class Square(Wave):
+    """Flash count times, high for on seconds of every period, then low"""
+
+    name = 'square'
+
+    def __init__(self, start, period, on, high, low=0, count=1, **kwargs):
+        super(Square, self).__init__(start, **kwargs)
+        if not 0 < on <= period:
+            raise ValueError('On must be within the period, got {} of '
+                             '{}'.format(on, period))
+        _check_count(count)
+        _check_intensities(high=high, low=low)
+        self.period = period
+        self.on = on
+        self.high = high
+        self.low = low
+        self.count = count
+
+    @property
+    def duration(self):
+        return self.period * self.count
+
+    @property
+    def parameters(self):
+        return {'period': self.period, 'on': self.on, 'high': self.high,
+                'low': self.low, 'count': self.count}
+
+    def intensity(self, seconds):
+        if seconds < self.duration and seconds % self.period < self.on:
+            return self.high
+        return self.low
+
+
+class LinearFade(Wave):
+    """Go from one intensity to another in duration seconds"""
+
+    name = 'linear'
+
+    def __init__(self, start, duration, begin, end, **kwargs):
+        super(LinearFade, self).__init__(start, **kwargs)
+        _check_positive(duration=duration)
+        _check_intensities(begin=begin, end=end)
+        self._duration = duration
+        self.begin = begin
+        self.end_intensity = end
+
+    @property
+    def duration(self):
+        return self._duration
+
+    @property
+    def parameters(self):
+        return {'duration': self._duration, 'begin': self.begin,
+                'end': self.end_intensity}
+
+    def intensity(self, seconds):
+        fraction = seconds / self._duration
+        return self.begin + (self.end_intensity - self.begin) * fraction
+
+
+class ExponentialFade(LinearFade):
+    """
+    Fade with a constant ratio per second instead of a constant step, which
+    looks even to the eye. Intensities are offset by one to allow zero.
+    """
+
+    name = 'exponential'
+
+    def intensity(self, seconds):
+        fraction = seconds / self._duration
+        ratio = (self.end_intensity + 1) / (self.begin + 1)
+        return (self.begin + 1) * ratio ** fraction - 1
+
+
+class Sine(Wave):
+    """Pulse count times between low and high, starting and ending low"""
+
+    name = 'sine'
+
+    def __init__(self, start, period, high, low=0, count=1, **kwargs):
+        super(Sine, self).__init__(start, **kwargs)
+        _check_positive(period=period)
+        _check_count(count)
+        _check_intensities(high=high, low=low)
+        self.period = period
+        self.high = high
+        self.low = low
+        self.count = count
+
+    @property
+    def duration(self):
+        return self.period * self.count
+
+    @property
+    def parameters(self):
+        return {'period': self.period, 'high': self.high, 'low': self.low,
+                'count': self.count}
+
+    def intensity(self, seconds):
+        phase = 2 * math.pi * seconds / self.period
+        return self.low + (self.high - self.low) * (1 - math.cos(phase)) / 2
+
+
+class Piecewise(Wave):
+    """Straight lines between points of [seconds, intensity]"""
+
+    name = 'piecewise'
+
+    def __init__(self, start, points, **kwargs):
+        super(Piecewise, self).__init__(start, **kwargs)
+        if not points:
+            raise ValueError('A piecewise curve needs points')
+        self.points = sorted([seconds, intensity]
+                             for seconds, intensity in points)
+        for seconds, intensity in self.points:
+            if seconds < 0:
+                raise ValueError('Points must not be before the start, '
+                                 'got {}'.format(seconds))
+            _check_intensities(point=intensity)
+        self._seconds = [seconds for seconds, _ in self.points]
+
+    @property
+    def duration(self):
+        return self._seconds[-1]
+
+    @property
+    def parameters(self):
+        return {'points': self.points}
+
+    def intensity(self, seconds):
+        index = bisect.bisect_right(self._seconds, seconds)
+        if index == 0:
+            return self.points[0][1]
+        if index == len(self.points):
+            return self.points[-1][1]
+        (x0, y0), (x1, y1) = self.points[index - 1], self.points[index]
+        return y0 + (y1 - y0) * (seconds - x0) / (x1 - x0)
+
+
+def _check_positive(**values):
+    for name, value in values.items():
+        if not value > 0:
+            raise ValueError('{} must be positive, got {}'.format(
+                name.capitalize(), value))
+
+
+def _check_count(count):
+    if not isinstance(count, int) or count < 1:
+        raise ValueError('Count must be a whole number of at least 1, '
+                         'got {}'.format(count))
+
+
+def _check_intensities(**intensities):
+    """Waves give actual intensities, DEFAULT is for schedules"""
+    for name, value in intensities.items():
+        if not 0 <= value <= MAX_INTENSITY:
+            raise ValueError('{} intensity must be between 0 and {}, '
+                             'got {}'.format(name.capitalize(),
+                                             MAX_INTENSITY, value))
+
+
+WAVES = {wave.name: wave for wave in (Square, LinearFade, ExponentialFade,
+                                      Sine, Piecewise)}
+
+
+def from_description(description):
+    """
+    The wave of a description, see Wave. Raises ValueError when it does not
+    describe a wave we can play.
+    """
+    try:
+        parameters = dict(description)
+        wave = WAVES[parameters.pop('wave')]
+        start = int(parameters.pop('start')) * 1000
+        leds = from_mask(parameters.pop('leds', 3))
+        return wave(start, leds=leds, **parameters)
+    except (KeyError, TypeError) as e:
+        raise ValueError('Not a wave description: {!r}'.format(e))
@@ -0,0 +1,200 @@
+import json
+import struct
+from datetime import datetime, timedelta
+
+JSON = 'ilp.json'
+BINARY = 'ilp.bin'
+
+# Negotiated per connection, in order of preference. Peers that do not ask
+# for a subprotocol get JSON.
+SUBPROTOCOLS = [BINARY, JSON]
+
+KIND_JSON = 0
+KIND_SCHEDULE = 1
+KIND_BATCH = 2
+
+KIND = struct.Struct('<B')
+HEADER_LENGTH = struct.Struct('<H')
+# Epoch in microseconds, LED mask, color, intensity
+SCHEDULE_ENTRY = struct.Struct('<qBif')
+# The columns of a schedule_batch message, with their struct format
+BATCH_COUNT = struct.Struct('<I')
+BATCH_COLUMNS = (('times', 'q'), ('leds', 'B'), ('colors', 'i'),
+                 ('intensities', 'f'))
+BATCH_NAMES = {name for name, _ in BATCH_COLUMNS}
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+TIMEFORMATS = ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S")
+
+
+def to_epoch_us(time):
+    """Parse a str(datetime) or datetime to microseconds since the epoch"""
+    if isinstance(time, str):
+        for timeformat in TIMEFORMATS:
+            try:
+                time = datetime.strptime(time, timeformat)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError('Unknown time format: {}'.format(time))
+    return (time - EPOCH) // MICROSECOND
+
+
+def from_epoch_us(epoch_us):
+    return EPOCH + epoch_us * MICROSECOND
+
+
+def to_mask(leds):
+    if not isinstance(leds, (tuple, list)):
+        leds = [leds]
+    mask = 0
+    for led in leds:
+        mask |= 1 << led
+    return mask
+
+
+def from_mask(mask):
+    return [i for i in range(8) if mask & (1 << i)]
+
+
+class JsonCodec(object):
+    name = JSON
+
+    def encode(self, message):
+        return json.dumps(message)
+
+    def decode(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf8')
+        return json.loads(data)
+
+
+class BinaryCodec(object):
+    """
+    Binary frames start with a kind byte.
+
+    KIND_JSON frames carry UTF-8 JSON. KIND_SCHEDULE frames carry a 'schedule'
+    message: the JSON of the message without its data, prefixed with its
+    length, followed by one SCHEDULE_ENTRY. KIND_BATCH frames carry a
+    'schedule_batch' message the same way, followed by the number of
+    entries and the BATCH_COLUMNS, one packed array each.
+
+    Messages decode to what JSON would give: ones that would come out
+    different, like int intensities, more data than the columns or floats
+    that float32 rounds, go as KIND_JSON. Frames that do not decode raise
+    ValueError, like bad JSON does.
+    """
+
+    name = BINARY
+
+    def encode(self, message):
+        for encode in (self._encode_schedule, self._encode_batch):
+            try:
+                return encode(message)
+            except (AttributeError, KeyError, TypeError, ValueError,
+                    struct.error):
+                pass
+        return KIND.pack(KIND_JSON) + json.dumps(message).encode('utf8')
+
+    def decode(self, data):
+        if isinstance(data, str):
+            return json.loads(data)
+        try:
+            kind = KIND.unpack_from(data)[0]
+            if kind == KIND_SCHEDULE:
+                return self._decode_schedule(data)
+            if kind == KIND_BATCH:
+                return self._decode_batch(data)
+        except (struct.error, TypeError) as e:
+            # Truncated, or a header that is not a message
+            raise ValueError('Not a binary frame: {}'.format(e))
+        return json.loads(data[KIND.size:].decode('utf8'))
+
+    def _encode_header(self, kind, message):
+        header = dict(message)
+        del header['data']
+        header = json.dumps(header).encode('utf8')
+        return KIND.pack(kind) + HEADER_LENGTH.pack(len(header)) + header
+
+    def _decode_header(self, data):
+        """Return the message without data, and the offset of the data"""
+        offset = KIND.size
+        length = HEADER_LENGTH.unpack_from(data, offset)[0]
+        offset += HEADER_LENGTH.size
+        message = json.loads(data[offset:offset + length].decode('utf8'))
+        return message, offset + length
+
+    def _encode_schedule(self, message):
+        if message.get('action') != 'schedule':
+            raise ValueError('Not a schedule message')
+        start_time, leds, color, intensity = message['data']
+        epoch_us = to_epoch_us(start_time)
+        entry = SCHEDULE_ENTRY.pack(epoch_us, to_mask(leds), color,
+                                    intensity)
+        if (not _fits('i', [color]) or not _fits('f', [intensity]) or
+                str(from_epoch_us(epoch_us)) != start_time or
+                from_mask(to_mask(leds)) != json.loads(json.dumps(leds))):
+            raise ValueError('Would not decode to the same schedule')
+        return self._encode_header(KIND_SCHEDULE, message) + entry
+
+    def _decode_schedule(self, data):
+        message, offset = self._decode_header(data)
+        epoch_us, mask, color, intensity = SCHEDULE_ENTRY.unpack_from(data,
+                                                                      offset)
+        message['data'] = [str(from_epoch_us(epoch_us)), from_mask(mask),
+                           color, intensity]
+        return message
+
+    def _encode_batch(self, message):
+        if message.get('action') != 'schedule_batch':
+            raise ValueError('Not a schedule_batch message')
+        data = message['data']
+        if set(data) != BATCH_NAMES:
+            raise ValueError('Not just the columns of a batch')
+        count = len(data['times'])
+        # struct.error when a column is shorter or longer than the times
+        columns = [struct.pack('<{}{}'.format(count, code), *data[name])
+                   for name, code in BATCH_COLUMNS]
+        for (name, code), column in zip(BATCH_COLUMNS, columns):
+            if not _fits(code, data[name], column):
+                raise ValueError('Would not decode to the same {}'.format(
+                    name))
+        return b''.join([self._encode_header(KIND_BATCH, message),
+                         BATCH_COUNT.pack(count)] + columns)
+
+    def _decode_batch(self, data):
+        message, offset = self._decode_header(data)
+        count = BATCH_COUNT.unpack_from(data, offset)[0]
+        offset += BATCH_COUNT.size
+        message['data'] = {}
+        for name, code in BATCH_COLUMNS:
+            column = struct.Struct('<{}{}'.format(count, code))
+            message['data'][name] = list(column.unpack_from(data, offset))
+            offset += column.size
+        return message
+
+
+def _fits(code, values, packed=None):
+    """Whether packed values unpack from struct format code as they are"""
+    if code != 'f':
+        # Only ints pack, in range, but bools would come back as ints
+        return not any(map(bool.__instancecheck__, values))
+    if not all(map(float.__instancecheck__, values)):
+        return False
+    if packed is None:
+        packed = struct.pack('<{}f'.format(len(values)), *values)
+    # Or float32 rounded them
+    return list(struct.unpack('<{}f'.format(len(values)), packed)) == values
+
+
+CODECS = {
+    JSON: JsonCodec(),
+    BINARY: BinaryCodec(),
+}
+
+
+def get_codec(subprotocol):
+    """Codec for a negotiated subprotocol, JSON if there is none"""
+    return CODECS.get(subprotocol, CODECS[JSON])